@@ -0,0 +1,235 @@
+#-------------------------------------------------------------
+#           Activity of the instance
+#
+#  Features:
+#  - samples the CPU, network and disk counters in /proc
+#  - reads the idle time of the X session (needs libXss)
+#  - keeps the samples in fixed-size ring buffers
+#  - reports when the instance stayed idle for a window
+#-------------------------------------------------------------
+
+import os
+import time
+import math
+import ctypes
+import ctypes.util
+import logging
+
+from tornado.ioloop import PeriodicCallback
+
+logger = logging.getLogger(__name__)
+
+SECTOR_SIZE = 512
+
+# block devices that do not stand for a disk of the instance
+IGNORED_DISKS = ('loop', 'ram', 'sr', 'fd', 'dm-', 'md')
+
+
+class RingBuffer(object):
+    """Keeps the last 'size' values."""
+
+    def __init__(self, size):
+        self._values = [0]*size
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def full(self):
+        return self._count == len(self._values)
+
+    def append(self, value):
+        self._values[self._next] = value
+        self._next = (self._next+1) % len(self._values)
+        self._count = min(self._count+1, len(self._values))
+
+    def max(self):
+        if self._count == 0:
+            return None
+        if self.full():
+            return max(self._values)
+        return max(self._values[:self._count])
+
+
+class ProcFile(object):
+    """Keeps a file in /proc open and reads it from the start on every call,
+       so a sample costs a single read() instead of an open()/close()."""
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def read(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self._fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class ProcSampler(object):
+    """Turns the counters of /proc/stat, /proc/net/dev and /proc/diskstats
+       into the CPU usage [0-1], the network traffic [bytes/s] and the disk
+       traffic [bytes/s] since the previous sample."""
+
+    def __init__(self, root='/proc'):
+        self._stat = ProcFile(os.path.join(root, 'stat'))
+        self._net = ProcFile(os.path.join(root, 'net/dev'))
+        self._disk = ProcFile(os.path.join(root, 'diskstats'))
+        self._disks = None
+        self._previous = None
+
+    def _cpu(self):
+        # cpu  user nice system idle iowait irq softirq steal ...
+        fields = self._stat.read().split('\n', 1)[0].split()[1:]
+        ticks = [int(field) for field in fields]
+        idle = sum(ticks[3:5])
+        return sum(ticks)-idle, sum(ticks)
+
+    def _network(self):
+        total = 0
+        for line in self._net.read().splitlines()[2:]:
+            name, counters = line.split(':', 1)
+            if name.strip() == 'lo':
+                continue
+            counters = counters.split()
+            total += int(counters[0])+int(counters[8])
+        return total
+
+    def _diskNames(self, names):
+        # skip the partitions of disks that are counted as a whole
+        names = [name for name in names if not name.startswith(IGNORED_DISKS)]
+        return set(name for name in names
+                   if not any(name != other and name.startswith(other) for other in names))
+
+    def _diskBytes(self):
+        rows = [line.split() for line in self._disk.read().splitlines()]
+        if self._disks is None:
+            self._disks = self._diskNames([row[2] for row in rows])
+        return SECTOR_SIZE*sum(int(row[5])+int(row[9]) for row in rows if row[2] in self._disks)
+
+    def sample(self):
+        """Returns the usage since the previous call, None on the first call."""
+        now = time.time()
+        busy, total = self._cpu()
+        current = (now, busy, total, self._network(), self._diskBytes())
+        previous, self._previous = self._previous, current
+        if previous is None:
+            return None
+        elapsed = max(now-previous[0], 1e-6)
+        return {'cpu'     : float(busy-previous[1])/max(total-previous[2], 1),
+                'network' : (current[3]-previous[3])/elapsed,
+                'disk'    : (current[4]-previous[4])/elapsed}
+
+    def close(self):
+        for procFile in (self._stat, self._net, self._disk):
+            procFile.close()
+
+
+class XScreenSaverInfo(ctypes.Structure):
+    _fields_ = [('window',       ctypes.c_ulong),
+                ('state',        ctypes.c_int),
+                ('kind',         ctypes.c_int),
+                ('til_or_since', ctypes.c_ulong),
+                ('idle',         ctypes.c_ulong),
+                ('eventMask',    ctypes.c_ulong)]
+
+
+class XIdleTime(object):
+    """Reads the time since the last input of the X session through the
+       screen saver extension. The connection to the display is kept open.
+       Returns None if libXss or the display are not available."""
+
+    def __init__(self, display):
+        self._display = None
+        try:
+            xlib = ctypes.cdll.LoadLibrary(ctypes.util.find_library('X11'))
+            xss = ctypes.cdll.LoadLibrary(ctypes.util.find_library('Xss'))
+        except (OSError, TypeError):
+            logger.warning("libX11 or libXss not found, the X session is not monitored")
+            return
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        xss.XScreenSaverAllocInfo.restype = ctypes.POINTER(XScreenSaverInfo)
+        xss.XScreenSaverQueryInfo.argtypes = [ctypes.c_void_p, ctypes.c_ulong,
+                                              ctypes.POINTER(XScreenSaverInfo)]
+        self._display = xlib.XOpenDisplay(display)
+        if not self._display:
+            logger.warning("Cannot open display %s, the X session is not monitored", display)
+            self._display = None
+            return
+        self._root = xlib.XDefaultRootWindow(self._display)
+        self._info = xss.XScreenSaverAllocInfo()
+        self._query = xss.XScreenSaverQueryInfo
+
+    def __call__(self):
+        if self._display is None:
+            return None
+        if not self._query(self._display, self._root, self._info):
+            return None
+        return self._info.contents.idle/1000.0
+
+
+class IdleDetector(object):
+    """Samples the activity every 'interval' seconds and calls 'onIdle' once
+       the CPU, network and disk usage stayed below 'thresholds' for 'window'
+       seconds and the X session had no input for as long. 'onActive' is
+       called as soon as a sample exceeds a threshold again, including the
+       first sample after the start."""
+
+    def __init__(self, sampler, thresholds, onIdle, onActive, interval=10, window=1800, xIdleTime=None):
+        self._sampler = sampler
+        self._thresholds = thresholds
+        self._onIdle = onIdle
+        self._onActive = onActive
+        self._window = window
+        self._xIdleTime = xIdleTime
+        size = int(math.ceil(float(window)/interval))
+        self._rings = dict((name, RingBuffer(size)) for name in thresholds)
+        self._periodic = PeriodicCallback(self._sample, interval*1000)
+        self.idle = None
+        self.latest = {}
+
+    def start(self):
+        self._sampler.sample()
+        self._periodic.start()
+
+    def stop(self):
+        self._periodic.stop()
+
+    def _isIdle(self):
+        for name, threshold in self._thresholds.iteritems():
+            if self._rings[name].max() >= threshold:
+                return False
+        if self._xIdleTime is not None:
+            xIdle = self._xIdleTime()
+            self.latest['x'] = xIdle
+            if (xIdle is not None) and (xIdle < self._window):
+                return False
+        if not all(ring.full() for ring in self._rings.itervalues()):
+            return None
+        return True
+
+    def _sample(self):
+        usage = self._sampler.sample()
+        if usage is None:
+            return
+        self.latest = usage
+        for name, ring in self._rings.iteritems():
+            ring.append(usage[name])
+        idle = self._isIdle()
+        if idle is None or idle == self.idle:
+            return
+        self.idle = idle
+        if idle:
+            self._onIdle()
+        else:
+            self._onActive()
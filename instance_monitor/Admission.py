@@ -0,0 +1,69 @@
+#-------------------------------------------------------------
+#           Admission control of the monitor API
+#
+#  Features:
+#  - token buckets per client and per route
+#  - bounded number of tracked clients
+#-------------------------------------------------------------
+
+import time
+import collections
+
+
+class TokenBucket(object):
+    """Refills 'rate' tokens per second up to 'burst' tokens."""
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.time()
+
+    def take(self):
+        """Takes a token. Returns 0 if a token was available, otherwise the
+           seconds until the next token is available."""
+        now = time.time()
+        self._tokens = min(self._burst, self._tokens+(now-self._updated)*self._rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1-self._tokens)/self._rate
+
+
+class RateLimits(object):
+    """A token bucket per key. A rate of 0 disables the limit. The buckets
+       of the least recently seen keys are dropped beyond 'maxKeys'."""
+
+    def __init__(self, rate=0, burst=1, maxKeys=10000):
+        self._rate = rate
+        self._burst = max(burst, 1)
+        self._maxKeys = maxKeys
+        self._buckets = collections.OrderedDict()
+
+    def take(self, key):
+        if self._rate <= 0:
+            return 0
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(self._rate, self._burst)
+            if len(self._buckets) >= self._maxKeys:
+                self._buckets.popitem(last=False)
+        self._buckets[key] = bucket
+        return bucket.take()
+
+
+class Admission(object):
+    """Admits a request if both its client and its route have a token left."""
+
+    def __init__(self, clientRate=0, clientBurst=1, routeRate=0, routeBurst=1):
+        self._clients = RateLimits(clientRate, clientBurst)
+        self._routes = RateLimits(routeRate, routeBurst)
+
+    def check(self, client, route):
+        """Returns 0 if the request is admitted, otherwise the seconds
+           after which the client should retry."""
+        wait = self._clients.take(client)
+        if wait > 0:
+            return wait
+        return self._routes.take(route)
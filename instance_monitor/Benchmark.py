@@ -0,0 +1,213 @@
+#-------------------------------------------------------------
+#           Load test of the instance monitor
+#
+#  Features:
+#  - in-process stand-ins for Keystone, Nova and the metadata service
+#  - configurable latency of the stand-ins
+#  - concurrent load on the API of the monitor
+#  - reports throughput, p50/p99 latency and IOLoop stalls
+#-------------------------------------------------------------
+
+import time
+import random
+import argparse
+import logging
+import ConfigParser
+
+from tornado import gen
+from tornado.web import RequestHandler, Application
+from tornado.ioloop import IOLoop
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+
+from instance_monitor import InstanceMonitor
+from instance_monitor.Metrics import LoopLagMonitor
+from instance_monitor.OpenStackClient import configureHTTPClient
+
+TENANT_ID = 'benchmark-tenant'
+INSTANCE_ID = 'benchmark-instance'
+
+# the requests the load generator picks from: name -> (method, path, body)
+ROUTES = {
+    'add'      : ('POST', '/shutdown/add',      'timeout=600'),
+    'get'      : ('GET',  '/shutdown/get',      None),
+    'getJSON'  : ('GET',  '/shutdown/get?format=json', None),
+    'list'     : ('GET',  '/shutdown/list',     None),
+    'metadata' : ('POST', '/metadata/set',      'name=benchmark&value=1'),
+}
+
+
+#-----------------------
+#  Upstream stand-ins
+#-----------------------
+class FakeServiceHandler(RequestHandler):
+    """Answers after the configured latency without blocking the IOLoop."""
+
+    def initialize(self, latency):
+        self._latency = latency
+
+    @gen.coroutine
+    def delay(self):
+        if self._latency > 0:
+            yield gen.Task(IOLoop.instance().add_timeout, time.time()+self._latency)
+
+    def log_exception(self, typ, value, tb):
+        pass
+
+
+class FakeTokensHandler(FakeServiceHandler):
+    @gen.coroutine
+    def post(self):
+        yield self.delay()
+        expires = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time()+3600))
+        self.write({'access': {'token': {'id': 'benchmark-token', 'expires': expires}}})
+
+
+class FakeMetadataServiceHandler(FakeServiceHandler):
+    @gen.coroutine
+    def get(self):
+        yield self.delay()
+        self.write({'uuid': INSTANCE_ID, 'meta': {}})
+
+
+class FakeServerHandler(FakeServiceHandler):
+    @gen.coroutine
+    def post(self, tenantId, instanceID):
+        yield self.delay()
+        self.write(self.request.body)
+
+    @gen.coroutine
+    def delete(self, tenantId, instanceID):
+        yield self.delay()
+        self.set_status(204)
+
+
+def createFakeServices(latency):
+    args = {'latency': latency}
+    return Application([
+        (r"/identity/tokens",                     FakeTokensHandler,          args),
+        (r"/metadata/meta_data.json",             FakeMetadataServiceHandler, args),
+        (r"/compute/([^/]+)/servers/([^/]+)/metadata", FakeServerHandler,     args),
+        (r"/compute/([^/]+)/servers/([^/]+)",     FakeServerHandler,          args),
+    ])
+
+
+#-----------------------
+#  Load generator
+#-----------------------
+class LagRecorder(object):
+    """Collects the lag values measured by the LoopLagMonitor."""
+
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value):
+        self.values.append(value)
+
+    def set(self, value):
+        pass
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values)*fraction), len(values)-1)]
+
+
+@gen.coroutine
+def generateLoad(port, routes, requests, concurrency):
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies = dict((route, []) for route in routes)
+    errors = dict((route, 0) for route in routes)
+    remaining = [requests]
+
+    @gen.coroutine
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            route = random.choice(routes)
+            method, path, body = ROUTES[route]
+            request = HTTPRequest('http://127.0.0.1:%i%s'%(port, path),
+                                  method=method, body=body)
+            start = time.time()
+            try:
+                yield client.fetch(request)
+            except HTTPError:
+                errors[route] += 1
+            latencies[route].append(time.time()-start)
+
+    start = time.time()
+    yield [worker() for i in range(concurrency)]
+    client.close()
+    raise gen.Return((time.time()-start, latencies, errors))
+
+
+def report(duration, latencies, errors, lags):
+    total = sum(len(values) for values in latencies.itervalues())
+    print "%-10s %8s %8s %10s %10s" % ("route", "requests", "errors", "p50 [ms]", "p99 [ms]")
+    for route in sorted(latencies):
+        values = latencies[route]
+        print "%-10s %8i %8i %10.2f %10.2f" % (route, len(values), errors[route],
+                                               1000*percentile(values, 0.5),
+                                               1000*percentile(values, 0.99))
+    print
+    print "Throughput       : %.1f requests/s" % (total/duration)
+    print "IOLoop lag p99   : %.2f ms" % (1000*percentile(lags, 0.99))
+    print "IOLoop lag max   : %.2f ms" % (1000*max(lags or [0]))
+
+
+#-----------------------
+#  Execute benchmark
+#-----------------------
+def main():
+    parser = argparse.ArgumentParser(prog='instmonbench',
+                                     description='Load test of the instance monitor')
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='Total number of API requests')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='Number of concurrent API requests')
+    parser.add_argument('--latency', type=float, default=50,
+                        help='Latency of the OpenStack stand-ins [ms]')
+    parser.add_argument('--routes', default=','.join(sorted(ROUTES)),
+                        help='Comma separated routes to load (%s)' % ', '.join(sorted(ROUTES)))
+    parser.add_argument('--port', type=int, default=18888,
+                        help='Port of the monitor, the stand-ins use the next port')
+    args = parser.parse_args()
+    routes = args.routes.split(',')
+    for route in routes:
+        if route not in ROUTES:
+            parser.error("unknown route '%s'" % route)
+
+    # only report warnings of the monitor, the access log would dominate the run time
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+    logging.getLogger(InstanceMonitor.__name__).setLevel(logging.WARNING)
+
+    # configure the monitor to use the stand-ins
+    servicesURL = 'http://127.0.0.1:%i' % (args.port+1)
+    confParser = ConfigParser.ConfigParser()
+    confParser.add_section('config')
+    confParser.add_section('init')
+    for name, value in [('port', str(args.port)), ('username', 'benchmark'),
+                        ('password', 'benchmark'), ('tenantId', TENANT_ID),
+                        ('authURL', servicesURL+'/identity'),
+                        ('novaURL', servicesURL+'/compute'),
+                        ('metadataURL', servicesURL+'/metadata/meta_data.json'),
+                        ('maxConnections', str(args.concurrency)),
+                        ('deleteConfig', 'False'),
+                        # the timers and writes of the load must not hit the caps
+                        ('maxTimers', '0'), ('maxPendingWrites', '0')]:
+        confParser.set('config', name, value)
+    confParser.set('init', 'countdown', '')
+    confParser.set('init', 'metadata', '')
+    InstanceMonitor.Configuration().clear()
+    InstanceMonitor.Configuration().update(InstanceMonitor.readConfiguration(confParser))
+    configureHTTPClient(args.concurrency)
+
+    createFakeServices(args.latency/1000.0).listen(args.port+1)
+    InstanceMonitor.createApplication().listen(args.port)
+    lags = LagRecorder()
+    LoopLagMonitor(lags, lags, 0.01).start()
+
+    duration, latencies, errors = IOLoop.instance().run_sync(
+        lambda: generateLoad(args.port, routes, args.requests, args.concurrency))
+    report(duration, latencies, errors, lags.values)
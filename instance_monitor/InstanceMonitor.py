@@ -3,26 +3,46 @@
 #
 #  Features:
 #  - shutdown the instance after a specified time
-#  - cancel and list running shutdowns
-#  - sets a metadata value
+#  - cancel single, cancel all and list running shutdowns
+#  - push changes of the shutdown schedule (long-poll and WebSocket)
+#  - keep the shutdown schedule in a journal across restarts
+#  - fleet mode: schedule shutdowns and set metadata for other instances
+#  - Prometheus metrics of the requests, upstream calls and the IOLoop
+#  - retries failed OpenStack calls and terminations
+#  - shutdown the instance once it stayed idle
+#  - runs the start scripts in the background and reports their output
+#  - rate limits per client and route, caps the timers and pending writes
+#  - sets one or several metadata values
+#  - serves the cached metadata document of the instance
 #-------------------------------------------------------------
 
 import os
+import re
 import sys
+import math
 import argparse
 import time
 import datetime
 import logging
 import ConfigParser
 import json
-import urllib2
 
-from tornado.web import RequestHandler, Application, asynchronous
+from tornado import gen
+from tornado.web import RequestHandler, Application, HTTPError, asynchronous
+from tornado.websocket import WebSocketHandler
 from tornado.httpserver import HTTPRequest
 from tornado.ioloop import IOLoop
 import tornado.log
 
-from subprocess import call
+from instance_monitor.OpenStackClient import OpenStackClient, MetadataWriteBuffer, TerminationQueue, \
+                                            Upstream, RetryBudget, QueueFullError, configureHTTPClient, \
+                                            METADATA_URL
+from instance_monitor.ShutdownScheduler import ShutdownScheduler
+from instance_monitor.ScheduleJournal import ScheduleJournal
+from instance_monitor.Metrics import Metrics, LoopLagMonitor
+from instance_monitor.ActivityMonitor import IdleDetector, ProcSampler, XIdleTime
+from instance_monitor.StartScripts import StartScriptRunner
+from instance_monitor.Admission import Admission
 
 # enable logging
 tornado.log.enable_pretty_logging()
@@ -30,54 +50,64 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
-# get the OpenStack token
-def getOpenStackToken():
-    conf = Configuration()
-    headers = {'Content-Type': 'application/json'}
-    body = {'auth' :{'passwordCredentials': {'username': conf['username'], 'password': conf['password']}, 'tenantId': conf['tenantId']}}
-    url = conf['authURL']+'/tokens'
-    req = urllib2.Request(url, headers=headers, data=json.dumps(body))
-    resp = urllib2.urlopen(req)
-    j = json.loads(resp.read())
-    return j['access']['token']['id']
-
-# get the instance ID
-def getInstanceID():
-    url = 'http://169.254.169.254/openstack/2012-08-10/meta_data.json'
-    req = urllib2.Request(url)
-    resp = urllib2.urlopen(req)
-    j = json.loads(resp.read())
-    return j['uuid']
-
-# set the instance's "nexel-ready" flag to true
-def setMetadata(token, instanceID, name, value):
-    if name == '':
+# schedulers of the shutdown timers, one per instance. The instance
+# the monitor runs on is stored under None.
+class __SchedulerSingleton(object):
+    schedulers = {}
+
+def Scheduler(instanceID=None):
+    schedulers = __SchedulerSingleton.schedulers
+    if instanceID not in schedulers:
+        scheduler = ShutdownScheduler(ShutdownInstance(instanceID)._shutdownInstance, instanceID)
+        if Journal() is not None:
+            scheduler.setJournal(Journal())
+        schedulers[instanceID] = scheduler
+    return schedulers[instanceID]
+
+def Schedulers():
+    return __SchedulerSingleton.schedulers
+
+# drop the scheduler of another instance once it has neither timers nor
+# listeners, so fleet requests for new instances cannot grow the schedulers
+def releaseScheduler(instanceID):
+    scheduler = Schedulers().get(instanceID)
+    if (instanceID is None) or (scheduler is None) or (len(scheduler) > 0) or scheduler.hasListeners():
         return
-    conf = Configuration()
-    headers = {'Content-Type': 'application/json'}
-    headers['X-Auth-Token'] = token
-    body = {'metadata': {name: value}}
-    url = conf['novaURL']+'/'+conf['tenantId']+'/servers/'+instanceID+'/metadata'
-    req = urllib2.Request(url, headers=headers, data=json.dumps(body))
-    urllib2.urlopen(req)
-
-# terminate the instance
-def terminateInstance(token, instanceID):
-    conf = Configuration()
-    headers = {'Content-Type': 'application/json'}
-    headers['X-Auth-Token'] = token
-    url = conf['novaURL']+'/'+conf['tenantId']+'/servers/'+instanceID
-    req = urllib2.Request(url, headers=headers)
-    req.get_method = lambda: 'DELETE'
-    urllib2.urlopen(req)
-
-
-# list of timeout handlers
-class __TimeoutSingleton(object):
-    l = []
-
-def Timeout():
-    return __TimeoutSingleton().l
+    del Schedulers()[instanceID]
+    if Journal() is not None:
+        Journal().forget(instanceID)
+
+# get the scheduler of an instance without creating it, read-only requests
+# get an empty scheduler for an unknown instance that is not kept
+def existingScheduler(instanceID=None):
+    if instanceID is None:
+        return Scheduler()
+    scheduler = Schedulers().get(instanceID)
+    if scheduler is None:
+        scheduler = ShutdownScheduler(None, instanceID)
+    return scheduler
+
+# get the scheduler of an instance that is watched for changes, which needs
+# the scheduler the timers of the instance are added to
+def watchedScheduler(instanceID=None):
+    if (instanceID is not None) and (instanceID not in Schedulers()):
+        raise HTTPError(404, "no shutdown schedule for instance %s"%instanceID)
+    return Scheduler(instanceID)
+
+
+# journal of the shutdown schedule
+class __JournalSingleton(object):
+    journal = None
+
+def Journal():
+    return __JournalSingleton.journal
+
+def setJournal(journal):
+    __JournalSingleton.journal = journal
+    journal.open(lambda: [timer for scheduler in Schedulers().itervalues()
+                                for timer in scheduler.timers()])
+    for scheduler in Schedulers().itervalues():
+        scheduler.setJournal(journal)
 
 
 # configuration
@@ -88,49 +118,255 @@ def Configuration():
     return __ConfigurationSingleton().d
 
 
+# client for the OpenStack services
+class __ClientSingleton(object):
+    client = None
+
+def Client():
+    if __ClientSingleton.client is None:
+        conf = Configuration()
+        upstream = Upstream(conf['retries'], RetryBudget(conf['retryBudget']),
+                            conf['breakerThreshold'], conf['breakerReset'])
+        __ClientSingleton.client = OpenStackClient(conf['authURL'], conf['novaURL'],
+                                                   conf['username'], conf['password'],
+                                                   conf['tenantId'], conf['tokenMargin'],
+                                                   conf['requestTimeout'], conf['metadataTTL'],
+                                                   conf['novaRate'], conf['metadataURL'],
+                                                   upstream)
+    return __ClientSingleton.client
+
+
+# queue of the terminations that have not been confirmed yet
+class __TerminationsSingleton(object):
+    queue = None
+
+def Terminations():
+    if __TerminationsSingleton.queue is None:
+        __TerminationsSingleton.queue = TerminationQueue(Client(), terminationConfirmed)
+    return __TerminationsSingleton.queue
+
+def terminationConfirmed(instanceID):
+    if Journal() is not None:
+        Journal().terminated(instanceID)
+
+
+# runner of the start scripts
+class __StartScriptsSingleton(object):
+    runner = StartScriptRunner([])
+
+def StartScripts():
+    return __StartScriptsSingleton.runner
+
+def runStartScripts(commands):
+    __StartScriptsSingleton.runner = StartScriptRunner(commands)
+    __StartScriptsSingleton.runner.start()
+
+
+# buffer that merges metadata writes
+class __WriterSingleton(object):
+    writer = None
+
+def Writer():
+    if __WriterSingleton.writer is None:
+        __WriterSingleton.writer = MetadataWriteBuffer(Client(), Configuration()['metadataWindow'],
+                                                       Configuration()['maxPendingWrites'])
+    return __WriterSingleton.writer
+
+
+# rate limits of the API
+class __AdmissionSingleton(object):
+    admission = None
+
+def Admissions():
+    if __AdmissionSingleton.admission is None:
+        conf = Configuration()
+        __AdmissionSingleton.admission = Admission(conf['clientRate'], conf['clientBurst'],
+                                                   conf['routeRate'], conf['routeBurst'])
+    return __AdmissionSingleton.admission
+
+
+# check the If-None-Match header of a request against an ETag
+def etagMatches(handler, etag):
+    inm = handler.request.headers.get('If-None-Match')
+    if (inm is None) or (etag is None):
+        return False
+    tags = [tag.strip() for tag in inm.split(',')]
+    return ('*' in tags) or (etag in tags) or ('W/'+etag in tags)
+
+
+# get the instance a request refers to. Other instances than the one the
+# monitor runs on (None) can only be given in fleet mode. The ID becomes
+# part of the Nova URLs, so only UUIDs are accepted.
+INSTANCE_ID = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+def instanceArgument(handler):
+    instanceID = handler.get_argument('instance', None)
+    if instanceID is None:
+        return None
+    if not Configuration()['fleet']:
+        raise HTTPError(400, "fleet mode is disabled")
+    if INSTANCE_ID.match(instanceID) is None:
+        raise HTTPError(400, "instance must be a UUID")
+    return instanceID.lower()
+
+
+# get a numeric argument of a request, an invalid value is answered with 400
+def numberArgument(handler, name, default=None, convert=int):
+    value = handler.get_argument(name, default)
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, "%s must be a number"%name)
+
+
+# check whether the client asked for a JSON response
+def wantsJSON(handler):
+    return (handler.get_argument('format', '') == 'json') or \
+           ('application/json' in handler.request.headers.get('Accept', ''))
+
+
+# write a JSON view of the shutdown schedule. The ETag is derived from the
+# schedule version, so an unchanged schedule is answered with 304.
+def writeSchedule(handler, scheduler, body):
+    etag = '"%s"'%scheduler.tag()
+    handler.set_header('Etag', etag)
+    if etagMatches(handler, etag):
+        handler.set_status(304)
+    else:
+        handler.set_header('Content-Type', 'application/json')
+        handler.write(json.dumps(body))
+
+
+# answer a request that is not admitted, the client may retry after 'retryAfter' seconds.
+# The reason phrase is given since httplib of Python 2 does not know 429.
+REJECT_PHRASES = {429: 'Too Many Requests', 503: 'Service Unavailable'}
+
+def reject(handler, code, reason, retryAfter=1):
+    handler.set_status(code, REJECT_PHRASES[code])
+    handler.set_header('Retry-After', str(int(math.ceil(retryAfter))))
+    handler.finish(reason)
+
+
+class AdmittedHandler(RequestHandler):
+    """Rejects the request with 429 if its client or route exceeded the rate limit."""
+
+    def prepare(self):
+        wait = Admissions().check(self.request.remote_ip, type(self).__name__)
+        if wait > 0:
+            reject(self, 429, "rate limit exceeded", wait)
+
+
+# log a finished request and record its latency
+def logRequest(handler):
+    status = handler.get_status()
+    if status < 400:
+        log = tornado.log.access_log.info
+    elif status < 500:
+        log = tornado.log.access_log.warning
+    else:
+        log = tornado.log.access_log.error
+    log("%d %s %.2fms", status, handler._request_summary(), 1000.0*handler.request.request_time())
+    Metrics().requestLatency.observe(handler.request.request_time(), type(handler).__name__, status)
+
+
+# log the failure of a background OpenStack call
+def logFailure(future):
+    if future.exception() is not None:
+        logger.error("OpenStack call failed: %s", future.exception())
+
+
 class ShutdownInstance():
 
-    _timoutHandle = None
+    def __init__(self, instanceID=None):
+        self._instanceID = instanceID
 
-    def _shutdownInstance(self):
-        handle = next((item for item in Timeout() if item['handle'] == self._timoutHandle), None)
-        if handle != None:
-            del Timeout()[:]
-            terminateInstance(getOpenStackToken(), getInstanceID())
+    def _shutdownInstance(self, timer):
+        Scheduler(self._instanceID).cancelAll()
+        releaseScheduler(self._instanceID)
+        if Journal() is not None:
+            Journal().terminate(self._instanceID)
+        Terminations().add(self._instanceID)
 
-    def addToIOLoop(self, timeout):
+    # returns the ID of the new timer or None if no timer was added
+    def addToIOLoop(self, timeout, reason=None):
         if timeout > -1:
-            self._timoutHandle = IOLoop.instance().add_timeout(time.time()+(timeout*60),self._shutdownInstance)
-            Timeout().append({'handle'   : self._timoutHandle,
-                              'start'    : time.time(),
-                              'duration' : timeout*60})
+            return Scheduler(self._instanceID).add(timeout*60, reason=reason)['id']
+        return None
+
+
+# arms a shutdown of the instance once it stayed idle and cancels
+# it again as soon as the instance is used
+class IdleShutdown(object):
+
+    def __init__(self, countdown):
+        self._countdown = countdown
+        self._timerID = None
+
+    # take over an idle timer that was restored from the journal
+    def adopt(self, timer):
+        self._timerID = timer['id']
+
+    def idle(self):
+        if (self._timerID is None) or (Scheduler().get(self._timerID) is None):
+            logger.info("Instance is idle, shutdown in %i min", self._countdown)
+            self._timerID = ShutdownInstance().addToIOLoop(self._countdown, 'idle')
+
+    def active(self):
+        if self._timerID is not None:
+            logger.info("Instance is in use, cancelling the idle shutdown")
+            Scheduler().cancel(self._timerID)
+            self._timerID = None
 
 
 # handler classes
-class AddShutdownHandler(RequestHandler):
-    _shtdwn = ShutdownInstance()
+class AddShutdownHandler(AdmittedHandler):
+    @asynchronous
+    def post(self):
+        timeout = numberArgument(self, 'timeout', '-1')
+        maxTimers = Configuration()['maxTimers']
+        if (timeout > -1) and (maxTimers > 0) and \
+           (sum(len(scheduler) for scheduler in Schedulers().itervalues()) >= maxTimers):
+            reject(self, 503, "too many shutdown timers", 60)
+            return
+        timerID = ShutdownInstance(instanceArgument(self)).addToIOLoop(timeout)
+        if timerID is not None:
+            self.write(str(timerID))
+        self.finish()
 
+
+class CancelShutdownHandler(AdmittedHandler):
     @asynchronous
     def post(self):
-        timeout = int(self.get_argument('timeout', '-1'))
-        self._shtdwn.addToIOLoop(timeout)
+        timerID = numberArgument(self, 'id')
+        instanceID = instanceArgument(self)
+        if existingScheduler(instanceID).cancel(timerID) is None:
+            raise HTTPError(404, "unknown timer %i"%timerID)
+        releaseScheduler(instanceID)
         self.finish()
 
 
-class CancelAllShutdownHandler(RequestHandler):
+class CancelAllShutdownHandler(AdmittedHandler):
     @asynchronous
     def post(self):
-        for item in Timeout():
-            IOLoop.instance().remove_timeout(item['handle'])
-        del Timeout()[:]
+        instanceID = instanceArgument(self)
+        existingScheduler(instanceID).cancelAll()
+        releaseScheduler(instanceID)
         self.finish()
 
 
 class ListShutdownHandler(RequestHandler):
     @asynchronous
     def get(self):
-        for item in Timeout():
+        scheduler = existingScheduler(instanceArgument(self))
+        if wantsJSON(self):
+            state = scheduler.state()
+            writeSchedule(self, scheduler, {'version' : state['version'],
+                                            'timers'  : state['timers']})
+            self.finish()
+            return
+        for item in scheduler.timers():
             output = "--------------\n"
+            output += "ID       : %i\n"%item['id']
             output += "Start    : %s\n"%time.strftime("%d %b %Y %H:%M:%S", time.localtime(item['start']))
             output += "End      : %s\n"%time.strftime("%d %b %Y %H:%M:%S", time.localtime(item['start']+item['duration']))
             output += "Remaining: %i min\n"%int((item['start']+item['duration']-time.time())/60)
@@ -141,46 +377,214 @@ class ListShutdownHandler(RequestHandler):
 class GetShutdownHandler(RequestHandler):
     @asynchronous
     def get(self):
+        scheduler = existingScheduler(instanceArgument(self))
+        if wantsJSON(self):
+            state = scheduler.state()
+            writeSchedule(self, scheduler, {'version'  : state['version'],
+                                            'earliest' : state['earliest']})
+            self.finish()
+            return
         minTime = 0
-        for item in Timeout():
-            itemTime = int((item['start']+item['duration']-time.time())/60)
-            if (minTime == 0) or (itemTime < minTime):
-                minTime = itemTime
+        item = scheduler.earliest()
+        if item is not None:
+            minTime = int((item['deadline']-time.time())/60)
         self.write(str(minTime))
         self.finish()
 
 
-class SetMetadataHandler(RequestHandler):
+class WatchShutdownHandler(RequestHandler):
+    """Long-poll for changes of the shutdown schedule. Returns the schedule as
+       soon as its version differs from the 'version' argument, or after
+       'timeout' seconds if nothing changed."""
+
+    @asynchronous
+    def get(self):
+        self._waitHandle = None
+        self._scheduler = watchedScheduler(instanceArgument(self))
+        version = self.get_argument('version', None)
+        timeout = max(min(numberArgument(self, 'timeout', '60', float), 300), 0)
+        if version != self._scheduler.tag():
+            self._sendState(self._scheduler)
+        else:
+            self._scheduler.addListener(self._sendState)
+            self._waitHandle = IOLoop.instance().add_timeout(time.time()+timeout,
+                                                             self._timeout)
+
+    def _timeout(self):
+        self._waitHandle = None
+        self._sendState(self._scheduler)
+
+    def _sendState(self, scheduler):
+        self._stopWaiting()
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(scheduler.state()))
+        self.finish()
+
+    def _stopWaiting(self):
+        self._scheduler.removeListener(self._sendState)
+        releaseScheduler(self._scheduler.instanceID)
+        if self._waitHandle is not None:
+            IOLoop.instance().remove_timeout(self._waitHandle)
+            self._waitHandle = None
+
+    def on_connection_close(self):
+        self._stopWaiting()
+
+
+class ShutdownSocketHandler(WebSocketHandler):
+    """Sends the shutdown schedule when the socket is opened and whenever it changes."""
+
+    _scheduler = None
+
+    def prepare(self):
+        # reject an unknown instance before the connection is upgraded
+        self._watched = watchedScheduler(instanceArgument(self))
+
+    def open(self):
+        self._scheduler = self._watched
+        self._scheduler.addListener(self._sendState)
+        self._sendState(self._scheduler)
+
+    def _sendState(self, scheduler):
+        self.write_message(json.dumps(scheduler.state()))
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        if self._scheduler is not None:
+            self._scheduler.removeListener(self._sendState)
+            releaseScheduler(self._scheduler.instanceID)
+
+
+class FleetShutdownHandler(RequestHandler):
+    """Lists the earliest deadline of every instance that has running shutdowns."""
+
+    @asynchronous
+    def get(self):
+        fleet = {}
+        for instanceID, scheduler in Schedulers().iteritems():
+            earliest = scheduler.earliest()
+            if earliest is not None:
+                fleet[instanceID or 'self'] = earliest['deadline']
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(fleet))
+        self.finish()
+
+
+class MetricsHandler(RequestHandler):
+    @asynchronous
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(Metrics().registry.render())
+        self.finish()
+
+
+class StartStatusHandler(RequestHandler):
+    """Reports the state of the start scripts. 'since' skips the output
+       lines a client has already seen."""
+
+    @asynchronous
+    def get(self):
+        since = numberArgument(self, 'since', 0)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(StartScripts().status(since)))
+        self.finish()
+
+
+class SetMetadataHandler(AdmittedHandler):
     @asynchronous
+    @gen.coroutine
     def post(self):
-        name  = self.get_argument('name', '')
-        value = self.get_argument('value', '')
-        setMetadata(getOpenStackToken(), getInstanceID(), name, value)
+        # several entries can be given as a JSON object, either in the
+        # 'metadata' argument or as the body of an application/json request
+        try:
+            if self.request.headers.get('Content-Type', '').startswith('application/json'):
+                metadata = json.loads(self.request.body)
+            elif self.get_argument('metadata', '') != '':
+                metadata = json.loads(self.get_argument('metadata'))
+            else:
+                metadata = {self.get_argument('name', ''): self.get_argument('value', '')}
+        except ValueError:
+            raise HTTPError(400, "metadata is not valid JSON")
+        if not isinstance(metadata, dict):
+            raise HTTPError(400, "metadata must be a JSON object")
+        instanceID = instanceArgument(self)
+        if instanceID is None:
+            instanceID = yield Client().getInstanceID()
+        try:
+            write = Writer().write(instanceID, metadata)
+        except QueueFullError:
+            reject(self, 503, "too many pending metadata writes")
+            return
+        yield write
         self.finish()
 
 
-def runStartScript():
-    call(Configuration()['startScript'], shell=True)
+class GetMetadataHandler(RequestHandler):
+    @asynchronous
+    @gen.coroutine
+    def get(self):
+        metadata = Client().metadata
+        yield metadata.get()
+        self.set_header('Etag', metadata.etag)
+        if etagMatches(self, metadata.etag):
+            self.set_status(304)
+        else:
+            self.set_header('Content-Type', 'application/json')
+            self.write(metadata.body)
+        self.finish()
 
 
-def main():
-    # read the configuration
-    parser = argparse.ArgumentParser(prog='instmonitord',
-                                     description='Instance monitor daemon')
-    parser.add_argument('<config_file>', action='store',
-                        help='Path to configuration file')
-    args = vars(parser.parse_args())
-    confPath = args['<config_file>']
+# set the metadata entries of the init section
+@gen.coroutine
+def setInitMetadata(metadata):
+    instanceID = yield Client().getInstanceID()
+    yield Writer().write(instanceID, metadata)
 
-    confParser = ConfigParser.ConfigParser()
-    confParser.read(confPath)
+
+# get an optional entry of the configuration file
+def getOption(confParser, section, name, default, convert=str):
+    if confParser.has_option(section, name):
+        return convert(confParser.get(section, name))
+    return default
+
+
+def readConfiguration(confParser):
     config = {}
-    config['port']         = int(confParser.get('config','port'))
-    config['username']     = confParser.get('config','username')
-    config['password']     = confParser.get('config','password')
-    config['tenantId']     = confParser.get('config','tenantId')
-    config['authURL']      = confParser.get('config','authURL')
-    config['novaURL']      = confParser.get('config','novaURL')
+    config['port']           = int(confParser.get('config','port'))
+    config['username']       = confParser.get('config','username')
+    config['password']       = confParser.get('config','password')
+    config['tenantId']       = confParser.get('config','tenantId')
+    config['authURL']        = confParser.get('config','authURL')
+    config['novaURL']        = confParser.get('config','novaURL')
+    config['metadataURL']    = getOption(confParser, 'config', 'metadataURL', METADATA_URL)
+    config['tokenMargin']    = getOption(confParser, 'config', 'tokenMargin', 300, int)
+    config['requestTimeout'] = getOption(confParser, 'config', 'requestTimeout', 10, float)
+    config['maxConnections'] = getOption(confParser, 'config', 'maxConnections', 10, int)
+    config['metadataTTL']    = getOption(confParser, 'config', 'metadataTTL', 300, int)
+    config['metadataWindow'] = getOption(confParser, 'config', 'metadataWindow', 0.1, float)
+    config['journal']        = getOption(confParser, 'config', 'journal', '')
+    config['journalSync']    = getOption(confParser, 'config', 'journalSync', 1.0, float)
+    config['fleet']          = getOption(confParser, 'config', 'fleet', 'False').lower() == "true"
+    config['novaRate']       = getOption(confParser, 'config', 'novaRate', 0, float)
+    config['retries']        = getOption(confParser, 'config', 'retries', 3, int)
+    config['retryBudget']    = getOption(confParser, 'config', 'retryBudget', 0.2, float)
+    config['breakerThreshold'] = getOption(confParser, 'config', 'breakerThreshold', 5, int)
+    config['breakerReset']   = getOption(confParser, 'config', 'breakerReset', 30, float)
+    config['clientRate']     = getOption(confParser, 'config', 'clientRate', 0, float)
+    config['clientBurst']    = getOption(confParser, 'config', 'clientBurst', 20, int)
+    config['routeRate']      = getOption(confParser, 'config', 'routeRate', 0, float)
+    config['routeBurst']     = getOption(confParser, 'config', 'routeBurst', 50, int)
+    config['maxTimers']      = getOption(confParser, 'config', 'maxTimers', 1000, int)
+    config['maxPendingWrites'] = getOption(confParser, 'config', 'maxPendingWrites', 1000, int)
+    config['idleInterval']   = getOption(confParser, 'idle', 'interval', 0, float)
+    config['idleWindow']     = getOption(confParser, 'idle', 'window', 1800, float)
+    config['idleCountdown']  = getOption(confParser, 'idle', 'countdown', 30, int)
+    config['idleCPU']        = getOption(confParser, 'idle', 'cpu', 0.05, float)
+    config['idleNetwork']    = getOption(confParser, 'idle', 'network', 10000, float)
+    config['idleDisk']       = getOption(confParser, 'idle', 'disk', 100000, float)
+    config['idleDisplay']    = getOption(confParser, 'idle', 'display', '')
     if confParser.get('config','deleteConfig').lower() == "true":
         config['deleteConfig'] = True
     else:
@@ -193,30 +597,103 @@ def main():
         config['metadata'] = json.loads(confParser.get('init','metadata'))
     else:
         config['metadata'] = {}
+    # one command per line
+    config['startScript'] = [line.strip() for line in getOption(confParser, 'init', 'startScript', '').splitlines()
+                             if line.strip() != '']
+    return config
+
+
+# the API of the server
+def createApplication():
+    return Application([
+        (r"/shutdown/add",       AddShutdownHandler),       # Shutdown the instance after the specified time [min], returns the timer ID
+        (r"/shutdown/cancel",    CancelShutdownHandler),    # Cancel the shutdown request with the specified ID
+        (r"/shutdown/cancelAll", CancelAllShutdownHandler), # Cancel all shutdown requests
+        (r"/shutdown/list",      ListShutdownHandler),      # Lists all currently running shutdowns (format=json for JSON)
+        (r"/shutdown/get",       GetShutdownHandler),       # Get the smallest remaining time of the currenty running shutdowns (format=json for the deadline)
+        (r"/shutdown/watch",     WatchShutdownHandler),     # Long-poll, returns the schedule once it differs from the given version
+        (r"/shutdown/socket",    ShutdownSocketHandler),    # WebSocket, pushes the schedule whenever it changes
+        (r"/shutdown/fleet",     FleetShutdownHandler),     # Get the earliest deadline of every instance with running shutdowns
+        (r"/metadata/set",       SetMetadataHandler),       # Sets one or several metadata entries to the specified values
+        (r"/metadata/get",       GetMetadataHandler),       # Get the cached metadata document of the instance
+        (r"/metrics",            MetricsHandler),           # Get the metrics in the Prometheus text format
+        (r"/start/status",       StartStatusHandler),       # Get the state, exit code, duration and output of the start scripts
+    ], log_function=logRequest)
+
+
+def main():
+    # read the configuration
+    parser = argparse.ArgumentParser(prog='instmonitord',
+                                     description='Instance monitor daemon')
+    parser.add_argument('<config_file>', action='store',
+                        help='Path to configuration file')
+    args = vars(parser.parse_args())
+    confPath = args['<config_file>']
+
+    confParser = ConfigParser.ConfigParser()
+    confParser.read(confPath)
+    config = readConfiguration(confParser)
 
     Configuration().clear()
     Configuration().update(config)
+    configureHTTPClient(config['maxConnections'])
 
     # the API of the server
-    application = Application([
-        (r"/shutdown/add",       AddShutdownHandler),       # Shutdown the instance after the specified time [sec]
-        (r"/shutdown/cancelAll", CancelAllShutdownHandler), # Cancel all shutdown requests
-        (r"/shutdown/list",      ListShutdownHandler),      # Lists all currently running shutdowns
-        (r"/shutdown/get",       GetShutdownHandler),       # Get the smallest remaining time of the currenty running shutdowns
-        (r"/metadata/set",       SetMetadataHandler),       # Sets a metadata entry to the specified value
-    ])
+    application = createApplication()
+
+    # collect the metrics of the IOLoop and the shutdown timers
+    Metrics().registry.gauge('instmonitord_shutdown_timers', 'Number of running shutdown timers',
+                             lambda: sum(len(scheduler) for scheduler in Schedulers().itervalues()))
+    Metrics().registry.gauge('instmonitord_terminations_pending', 'Number of unconfirmed terminations',
+                             lambda: len(Terminations()))
+    LoopLagMonitor(Metrics().loopLag, Metrics().loopLagLast).start()
 
     # delete the config file if the associated flag is set to True
     if config['deleteConfig']:
         os.remove(confPath)
 
+    # keep the metadata document of the instance up to date
+    Client().metadata.start()
+
+    # restore the shutdowns that were scheduled before a restart. The init
+    # countdown is only added on the first start, later it is in the journal.
+    idleShutdown = IdleShutdown(config['idleCountdown'])
+    restarted = (config['journal'] != '') and os.path.exists(config['journal'])
+    if config['journal'] != '':
+        journal = ScheduleJournal(config['journal'], config['journalSync'])
+        for timer in journal.load():
+            logger.info("Restoring shutdown %i of %s at %s", timer['id'], timer['instance'] or 'this instance',
+                        time.strftime("%d %b %Y %H:%M:%S", time.localtime(timer['deadline'])))
+            Scheduler(timer['instance']).add(timer['duration'], timer['start'], timer['id'], timer['reason'])
+            if (timer['instance'] is None) and (timer['reason'] == 'idle'):
+                idleShutdown.adopt(timer)
+        setJournal(journal)
+        for instanceID in list(journal.pendingTerminations):
+            logger.info("Resuming termination of %s", instanceID or 'this instance')
+            Terminations().add(instanceID)
+
     # perform the init commands
-    ShutdownInstance().addToIOLoop(config['countdown'])
-    for key, value in config['metadata'].iteritems():
-        setMetadata(getOpenStackToken(), getInstanceID(), key, value)
+    if not restarted:
+        ShutdownInstance().addToIOLoop(config['countdown'])
+    if config['metadata']:
+        IOLoop.instance().add_future(setInitMetadata(config['metadata']), logFailure)
+
+    # shutdown the instance once it stayed idle
+    if config['idleInterval'] > 0:
+        thresholds = {'cpu': config['idleCPU'], 'network': config['idleNetwork'], 'disk': config['idleDisk']}
+        xIdleTime = XIdleTime(config['idleDisplay']) if config['idleDisplay'] != '' else None
+        detector = IdleDetector(ProcSampler(), thresholds, idleShutdown.idle, idleShutdown.active,
+                                config['idleInterval'], config['idleWindow'], xIdleTime)
+        Metrics().registry.gauge('instmonitord_idle', 'Whether the instance is idle',
+                                 lambda: 1 if detector.idle else 0)
+        detector.start()
 
     # Start the http server
     application.listen(config['port'])
 
+    # run the start scripts once the IOLoop is running, the API is available meanwhile
+    if config['startScript']:
+        IOLoop.instance().add_callback(runStartScripts, config['startScript'])
+
     # start the IOLoop
     IOLoop.instance().start()
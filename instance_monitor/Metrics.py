@@ -0,0 +1,157 @@
+#-------------------------------------------------------------
+#           Metrics of the instance monitor
+#
+#  Features:
+#  - counters, gauges and latency histograms with labels
+#  - measures the lag of the IOLoop
+#  - renders all metrics in the Prometheus text format
+#-------------------------------------------------------------
+
+import time
+import bisect
+
+from tornado.ioloop import IOLoop
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# format the labels of a sample, e.g. {handler="AddShutdownHandler"}
+def formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values))+list(extra)
+    if not pairs:
+        return ''
+    return '{'+','.join('%s="%s"'%(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for name, value in pairs)+'}'
+
+
+class Counter(object):
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *labelValues):
+        self._values[labelValues] = self._values.get(labelValues, 0)+1
+
+    def render(self):
+        lines = ['# HELP %s %s'%(self.name, self.description),
+                 '# TYPE %s counter'%self.name]
+        for labelValues, value in sorted(self._values.iteritems()):
+            lines.append('%s%s %s'%(self.name, formatLabels(self.labels, labelValues), value))
+        return lines
+
+
+class Gauge(object):
+    """A gauge is either set explicitly or read from 'function' when rendered."""
+
+    def __init__(self, name, description, function=None):
+        self.name = name
+        self.description = description
+        self._function = function
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def render(self):
+        value = self._function() if self._function is not None else self._value
+        return ['# HELP %s %s'%(self.name, self.description),
+                '# TYPE %s gauge'%self.name,
+                '%s %s'%(self.name, value)]
+
+
+class Histogram(object):
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._buckets = buckets
+        self._values = {}
+
+    def observe(self, value, *labelValues):
+        entry = self._values.setdefault(labelValues, [[0]*len(self._buckets), 0.0, 0])
+        index = bisect.bisect_left(self._buckets, value)
+        if index < len(self._buckets):
+            entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s'%(self.name, self.description),
+                 '# TYPE %s histogram'%self.name]
+        for labelValues, (counts, total, count) in sorted(self._values.iteritems()):
+            cumulative = 0
+            for bound, bucketCount in zip(self._buckets, counts):
+                cumulative += bucketCount
+                lines.append('%s_bucket%s %i'%(self.name,
+                             formatLabels(self.labels, labelValues, [('le', repr(bound))]), cumulative))
+            lines.append('%s_bucket%s %i'%(self.name,
+                         formatLabels(self.labels, labelValues, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %s'%(self.name, formatLabels(self.labels, labelValues), repr(total)))
+            lines.append('%s_count%s %i'%(self.name, formatLabels(self.labels, labelValues), count))
+        return lines
+
+
+class LoopLagMonitor(object):
+    """Schedules a callback every 'interval' seconds and records how late it
+       runs. A blocking call in the IOLoop shows up as a large lag."""
+
+    def __init__(self, histogram, gauge, interval=0.5):
+        self._histogram = histogram
+        self._gauge = gauge
+        self._interval = interval
+        self._expected = None
+
+    def start(self):
+        self._expected = time.time()+self._interval
+        IOLoop.instance().add_timeout(self._expected, self._check)
+
+    def _check(self):
+        lag = max(time.time()-self._expected, 0)
+        self._histogram.observe(lag)
+        self._gauge.set(lag)
+        self.start()
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, function=None):
+        return self.register(Gauge(name, description, function))
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines)+'\n'
+
+
+# the metrics shared by the whole monitor
+class __MetricsSingleton(object):
+    registry = MetricsRegistry()
+    requestLatency = registry.histogram('instmonitord_request_duration_seconds',
+                                        'Latency of the API requests', ('handler', 'code'))
+    upstreamLatency = registry.histogram('instmonitord_upstream_duration_seconds',
+                                         'Latency of the calls to the OpenStack services', ('call',))
+    upstreamErrors = registry.counter('instmonitord_upstream_errors_total',
+                                      'Failed calls to the OpenStack services', ('call',))
+    loopLag = registry.histogram('instmonitord_ioloop_lag_seconds',
+                                 'Delay of the IOLoop lag probe')
+    loopLagLast = registry.gauge('instmonitord_ioloop_lag_last_seconds',
+                                 'Delay of the most recent IOLoop lag probe')
+
+def Metrics():
+    return __MetricsSingleton
+
@@ -0,0 +1,544 @@
+#-------------------------------------------------------------
+#           Client for the OpenStack services
+#
+#  Features:
+#  - requests and caches the Keystone token
+#  - refreshes the token ahead of its expiry
+#  - non-blocking calls to the metadata service and Nova
+#  - caches the document of the metadata service
+#  - merges metadata writes into a single Nova request
+#  - bounds the number of pending metadata writes
+#  - limits the rate of the Nova requests
+#  - retries failed calls with backoff within a retry budget
+#  - circuit breakers for Keystone, Nova and the metadata service
+#  - retries terminations until they are confirmed
+#-------------------------------------------------------------
+
+import time
+import random
+import calendar
+import logging
+import json
+import hashlib
+from functools import partial
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+
+from instance_monitor.Metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+METADATA_URL = 'http://169.254.169.254/openstack/2012-08-10/meta_data.json'
+
+# bounds of the delay before a token is refreshed or a failed refresh is retried [s]
+MIN_REFRESH_DELAY = 10
+MAX_REFRESH_DELAY = 300
+
+
+# select the HTTP client used for all upstream calls. The curl based client keeps
+# the connections alive between calls, so it is used whenever pycurl is available.
+def configureHTTPClient(maxClients=10):
+    try:
+        import pycurl
+        AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient',
+                                  max_clients=maxClients)
+    except ImportError:
+        logger.warning("pycurl is not available, upstream connections are not kept alive")
+        AsyncHTTPClient.configure(None, max_clients=maxClients)
+
+
+# convert a Keystone timestamp (e.g. 2013-02-27T18:30:59Z) into seconds since the epoch
+def parseTimestamp(value):
+    return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+# build a JSON request for one of the OpenStack services
+def jsonRequest(url, method='GET', body=None, token=None, timeout=10):
+    headers = {'Content-Type': 'application/json'}
+    if token is not None:
+        headers['X-Auth-Token'] = token
+    if body is not None:
+        body = json.dumps(body)
+    return HTTPRequest(url, method=method, headers=headers, body=body,
+                       connect_timeout=timeout, request_timeout=timeout)
+
+
+# fetch a request and record its latency and failure under the name 'call'
+@gen.coroutine
+def timedFetch(call, request):
+    start = time.time()
+    try:
+        resp = yield AsyncHTTPClient().fetch(request)
+    except Exception:
+        Metrics().upstreamErrors.inc(call)
+        raise
+    finally:
+        Metrics().upstreamLatency.observe(time.time()-start, call)
+    raise gen.Return(resp)
+
+
+# wait for 'delay' seconds without blocking the IOLoop
+def sleep(delay):
+    return gen.Task(IOLoop.instance().add_timeout, time.time()+delay)
+
+
+# exponential backoff with full jitter
+def backoff(attempt, base=0.1, cap=10):
+    return random.uniform(0, min(cap, base*(2**attempt)))
+
+
+# timeouts, connection errors, throttling and server errors are worth a retry
+def isRetryable(error):
+    if isinstance(error, HTTPError):
+        return (error.code == 599) or (error.code == 429) or (error.code >= 500)
+    return isinstance(error, IOError)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Opens after 'threshold' consecutive failures of a service. While open,
+       calls fail immediately with a CircuitOpenError. After 'resetTimeout'
+       seconds a single trial call is let through, which closes the breaker
+       again if it succeeds."""
+
+    def __init__(self, name, threshold=5, resetTimeout=30):
+        self.name = name
+        self._threshold = threshold
+        self._resetTimeout = resetTimeout
+        self._failures = 0
+        self._openedAt = None
+        self._trial = False
+
+    def isOpen(self):
+        return self._openedAt is not None
+
+    def before(self):
+        if self._openedAt is None:
+            return
+        if self._trial or (time.time() < self._openedAt+self._resetTimeout):
+            raise CircuitOpenError("%s is unavailable"%self.name)
+        self._trial = True
+
+    def success(self):
+        if self._openedAt is not None:
+            logger.info("%s is available again", self.name)
+        self._failures = 0
+        self._openedAt = None
+        self._trial = False
+
+    def failure(self):
+        self._failures += 1
+        if self._trial or (self._failures >= self._threshold):
+            if self._openedAt is None:
+                logger.warning("%s failed %i times, calls fail fast for %i s",
+                               self.name, self._failures, self._resetTimeout)
+            self._openedAt = time.time()
+        self._trial = False
+
+
+class RetryBudget(object):
+    """Every call deposits 'ratio' tokens and every retry withdraws one, so
+       retries stay limited to about 'ratio' of the calls. At most 'maximum'
+       tokens are saved up for bursts."""
+
+    def __init__(self, ratio=0.2, maximum=10):
+        self._ratio = ratio
+        self._maximum = maximum
+        self._tokens = maximum
+
+    def deposit(self):
+        self._tokens = min(self._tokens+self._ratio, self._maximum)
+
+    def withdraw(self):
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+class Upstream(object):
+    """Calls the OpenStack services. Retryable failures are retried up to
+       'retries' times with jittered exponential backoff as long as the shared
+       retry budget allows it. Every service has its own circuit breaker."""
+
+    def __init__(self, retries=3, budget=None, threshold=5, resetTimeout=30):
+        self._retries = retries
+        self._budget = budget if budget is not None else RetryBudget()
+        self._threshold = threshold
+        self._resetTimeout = resetTimeout
+        self._breakers = {}
+
+    def breaker(self, service):
+        if service not in self._breakers:
+            self._breakers[service] = CircuitBreaker(service, self._threshold, self._resetTimeout)
+        return self._breakers[service]
+
+    @gen.coroutine
+    def fetch(self, service, call, request):
+        breaker = self.breaker(service)
+        self._budget.deposit()
+        attempt = 0
+        while True:
+            breaker.before()
+            try:
+                resp = yield timedFetch(call, request)
+            except Exception as e:
+                if not isRetryable(e):
+                    # the service answered, the request itself was refused
+                    breaker.success()
+                    raise
+                breaker.failure()
+                if (attempt >= self._retries) or breaker.isOpen() or not self._budget.withdraw():
+                    raise
+                delay = backoff(attempt)
+                logger.debug("Retrying %s in %.2f s after: %s", call, delay, e)
+                yield sleep(delay)
+                attempt += 1
+                continue
+            breaker.success()
+            raise gen.Return(resp)
+
+
+class TokenCache(object):
+    """Caches the Keystone token together with its expiry time.
+       The token is refreshed in the background 'margin' seconds before it expires,
+       but not before half of its lifetime has passed, so short-lived tokens
+       or a skewed clock do not cause a refresh loop. Concurrent refreshes are
+       collapsed into a single Keystone request."""
+
+    def __init__(self, upstream, authURL, username, password, tenantId, margin=300, timeout=10):
+        self._upstream = upstream
+        self._url = authURL+'/tokens'
+        self._body = {'auth' :{'passwordCredentials': {'username': username, 'password': password}, 'tenantId': tenantId}}
+        self._margin = margin
+        self._timeout = timeout
+        self._token = None
+        self._expires = 0
+        self._refreshAt = 0
+        self._retryDelay = MIN_REFRESH_DELAY
+        self._pending = None
+        self._refreshHandle = None
+
+    def _isValid(self):
+        return (self._token is not None) and (time.time() < self._refreshAt)
+
+    def _scheduleRefresh(self, when):
+        if self._refreshHandle is not None:
+            IOLoop.instance().remove_timeout(self._refreshHandle)
+        self._refreshHandle = IOLoop.instance().add_timeout(when, self._backgroundRefresh)
+
+    def _backgroundRefresh(self):
+        self._refreshHandle = None
+        IOLoop.instance().add_future(self.refresh(), self._backgroundRefreshDone)
+
+    def _backgroundRefreshDone(self, future):
+        if future.exception() is not None:
+            # retry with an exponential backoff while Keystone fails
+            logger.error("Background refresh of the OpenStack token failed, retrying in %i s: %s",
+                         self._retryDelay, future.exception())
+            self._scheduleRefresh(time.time()+self._retryDelay)
+            self._retryDelay = min(2*self._retryDelay, MAX_REFRESH_DELAY)
+        else:
+            self._retryDelay = MIN_REFRESH_DELAY
+
+    @gen.coroutine
+    def _requestToken(self):
+        try:
+            resp = yield self._upstream.fetch('keystone', 'token',
+                                              jsonRequest(self._url, 'POST', self._body,
+                                                          timeout=self._timeout))
+            j = json.loads(resp.body)
+            self._token = j['access']['token']['id']
+            self._expires = parseTimestamp(j['access']['token']['expires'])
+            now = time.time()
+            self._refreshAt = max(self._expires-self._margin,
+                                  now+(self._expires-now)/2.0,
+                                  now+MIN_REFRESH_DELAY)
+            logger.debug("Received new OpenStack token, expires %s",
+                         time.strftime("%d %b %Y %H:%M:%S", time.localtime(self._expires)))
+            self._scheduleRefresh(self._refreshAt)
+            raise gen.Return(self._token)
+        finally:
+            self._pending = None
+
+    def refresh(self):
+        # all callers share the Keystone request that is currently in flight
+        if self._pending is None:
+            future = self._requestToken()
+            if not future.done():
+                self._pending = future
+            return future
+        return self._pending
+
+    def invalidate(self):
+        self._token = None
+        self._expires = 0
+        self._refreshAt = 0
+
+    @gen.coroutine
+    def get(self):
+        if self._isValid():
+            raise gen.Return(self._token)
+        token = yield self.refresh()
+        raise gen.Return(token)
+
+
+class MetadataCache(object):
+    """Keeps the parsed document of the metadata service in memory.
+       The document is fetched once and then refreshed every 'ttl' seconds.
+       If a refresh fails the previous document is kept."""
+
+    def __init__(self, upstream, url=METADATA_URL, ttl=300, timeout=10):
+        self._upstream = upstream
+        self._url = url
+        self._timeout = timeout
+        self._document = None
+        self._body = None
+        self._etag = None
+        self._pending = None
+        self._periodic = PeriodicCallback(self._backgroundRefresh, ttl*1000)
+
+    def start(self):
+        self._periodic.start()
+
+    def stop(self):
+        self._periodic.stop()
+
+    def _backgroundRefresh(self):
+        IOLoop.instance().add_future(self.refresh(), self._backgroundRefreshDone)
+
+    def _backgroundRefreshDone(self, future):
+        if future.exception() is not None:
+            logger.error("Refresh of the instance metadata failed: %s", future.exception())
+
+    @gen.coroutine
+    def _requestDocument(self):
+        try:
+            resp = yield self._upstream.fetch('metadata', 'metadata',
+                                              jsonRequest(self._url, timeout=self._timeout))
+            self._document = json.loads(resp.body)
+            self._body = resp.body
+            self._etag = '"%s"'%hashlib.sha1(resp.body).hexdigest()
+            raise gen.Return(self._document)
+        finally:
+            self._pending = None
+
+    def refresh(self):
+        # all callers share the request that is currently in flight
+        if self._pending is None:
+            future = self._requestDocument()
+            if not future.done():
+                self._pending = future
+            return future
+        return self._pending
+
+    @property
+    def body(self):
+        return self._body
+
+    @property
+    def etag(self):
+        return self._etag
+
+    @gen.coroutine
+    def get(self):
+        if self._document is None:
+            yield self.refresh()
+        raise gen.Return(self._document)
+
+
+class RateLimiter(object):
+    """Spaces calls at least 1/'rate' seconds apart. acquire() returns a future
+       that resolves once the caller may proceed. A rate of 0 disables the limit."""
+
+    def __init__(self, rate=0):
+        self._interval = 1.0/rate if rate > 0 else 0
+        self._nextSlot = 0
+
+    def acquire(self):
+        future = Future()
+        now = time.time()
+        slot = max(now, self._nextSlot)
+        self._nextSlot = slot+self._interval
+        if slot <= now:
+            future.set_result(None)
+        else:
+            IOLoop.instance().add_timeout(slot, partial(future.set_result, None))
+        return future
+
+
+class OpenStackClient(object):
+    """Non-blocking client for the metadata service and Nova.
+       All calls are coroutines and share the cached Keystone token.
+       Nova requests are limited to 'novaRate' per second (0 for no limit).
+       All requests go through 'upstream', which retries them and guards the
+       services with circuit breakers."""
+
+    def __init__(self, authURL, novaURL, username, password, tenantId,
+                 tokenMargin=300, timeout=10, metadataTTL=300, novaRate=0,
+                 metadataURL=METADATA_URL, upstream=None):
+        self._serversURL = novaURL+'/'+tenantId+'/servers/'
+        self._timeout = timeout
+        self._upstream = upstream if upstream is not None else Upstream()
+        self._token = TokenCache(self._upstream, authURL, username, password, tenantId,
+                                 tokenMargin, timeout)
+        self.metadata = MetadataCache(self._upstream, metadataURL, metadataTTL, timeout)
+        self._novaLimiter = RateLimiter(novaRate)
+
+    @gen.coroutine
+    def _novaFetch(self, call, url, method, body=None):
+        # retry once with a fresh token if Nova rejected the cached one
+        yield self._novaLimiter.acquire()
+        token = yield self._token.get()
+        try:
+            resp = yield self._upstream.fetch('nova', call,
+                                              jsonRequest(url, method, body, token, self._timeout))
+        except HTTPError as e:
+            if e.code != 401:
+                raise
+            self._token.invalidate()
+            token = yield self._token.get()
+            resp = yield self._upstream.fetch('nova', call,
+                                              jsonRequest(url, method, body, token, self._timeout))
+        raise gen.Return(resp)
+
+    # get the OpenStack token
+    @gen.coroutine
+    def getToken(self):
+        token = yield self._token.get()
+        raise gen.Return(token)
+
+    # get the instance ID
+    @gen.coroutine
+    def getInstanceID(self):
+        document = yield self.metadata.get()
+        raise gen.Return(document['uuid'])
+
+    # set a metadata entry of the instance
+    @gen.coroutine
+    def setMetadata(self, instanceID, name, value):
+        yield self.updateMetadata(instanceID, {name: value})
+
+    # set several metadata entries of the instance with a single request
+    @gen.coroutine
+    def updateMetadata(self, instanceID, metadata):
+        metadata = dict((name, value) for name, value in metadata.iteritems() if name != '')
+        if not metadata:
+            return
+        yield self._novaFetch('nova_metadata', self._serversURL+instanceID+'/metadata', 'POST',
+                              {'metadata': metadata})
+
+    # terminate the instance, an instance that no longer exists counts as terminated
+    @gen.coroutine
+    def terminateInstance(self, instanceID):
+        try:
+            yield self._novaFetch('nova_delete', self._serversURL+instanceID, 'DELETE')
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+
+
+class MetadataWriteBuffer(object):
+    """Collects metadata writes for 'window' seconds and sends them to Nova
+       as a single request per instance. Later writes of the same key win.
+       The future returned by write() resolves once its batch has been sent.
+       At most 'maxPending' writes wait for Nova (0 for no limit), further
+       writes raise a QueueFullError."""
+
+    def __init__(self, client, window=0.1, maxPending=0):
+        self._client = client
+        self._window = window
+        self._maxPending = maxPending
+        self._pending = 0
+        self._batches = {}
+
+    def __len__(self):
+        return self._pending
+
+    def write(self, instanceID, metadata):
+        if (self._maxPending > 0) and (self._pending >= self._maxPending):
+            raise QueueFullError("%i metadata writes are pending" % self._pending)
+        self._pending += 1
+        future = Future()
+        if instanceID not in self._batches:
+            self._batches[instanceID] = ({}, [])
+            IOLoop.instance().add_timeout(time.time()+self._window,
+                                          partial(self._flush, instanceID))
+        pending, futures = self._batches[instanceID]
+        pending.update(metadata)
+        futures.append(future)
+        return future
+
+    def _flush(self, instanceID):
+        pending, futures = self._batches.pop(instanceID)
+        logger.debug("Sending %i metadata entries for %i writes", len(pending), len(futures))
+        IOLoop.instance().add_future(self._client.updateMetadata(instanceID, pending),
+                                     partial(self._flushDone, futures))
+
+    def _flushDone(self, futures, result):
+        self._pending -= len(futures)
+        for future in futures:
+            if result.exception() is not None:
+                future.set_exception(result.exception())
+            else:
+                future.set_result(None)
+
+
+class TerminationQueue(object):
+    """Terminates instances and keeps retrying with backoff (up to 'maxDelay'
+       seconds between attempts) until Nova confirmed the termination.
+       The instance the monitor runs on is queued as None. 'onConfirmed' is
+       called with the instance once it has been terminated."""
+
+    def __init__(self, client, onConfirmed=None, maxDelay=300):
+        self._client = client
+        self._onConfirmed = onConfirmed
+        self._maxDelay = maxDelay
+        self._pending = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, instanceID):
+        return instanceID in self._pending
+
+    def add(self, instanceID):
+        if instanceID in self._pending:
+            return
+        self._pending.add(instanceID)
+        IOLoop.instance().add_future(self._terminate(instanceID), self._unexpectedFailure)
+
+    def _unexpectedFailure(self, future):
+        if future.exception() is not None:
+            logger.error("Termination stopped: %s", future.exception())
+
+    @gen.coroutine
+    def _terminate(self, instanceID):
+        attempt = 0
+        while True:
+            try:
+                serverID = instanceID
+                if serverID is None:
+                    serverID = yield self._client.getInstanceID()
+                yield self._client.terminateInstance(serverID)
+                break
+            except Exception as e:
+                delay = max(backoff(attempt, 1, self._maxDelay), 1)
+                logger.error("Terminating %s failed, retrying in %.0f s: %s",
+                             instanceID or 'this instance', delay, e)
+                yield sleep(delay)
+                attempt += 1
+        logger.info("Terminated %s", instanceID or 'this instance')
+        self._pending.discard(instanceID)
+        if self._onConfirmed is not None:
+            self._onConfirmed(instanceID)
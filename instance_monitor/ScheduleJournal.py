@@ -0,0 +1,164 @@
+#-------------------------------------------------------------
+#           Journal of the shutdown schedule
+#
+#  Features:
+#  - append-only file of the schedule mutations
+#  - batched fsync of the appended records
+#  - compaction into a snapshot of the running timers
+#  - replay of the journal at startup
+#  - keeps terminations pending until they are confirmed
+#-------------------------------------------------------------
+
+import os
+import json
+import logging
+
+from tornado.ioloop import PeriodicCallback
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduleJournal(object):
+    """Appends every mutation of the shutdown schedule as a JSON line to 'path'.
+       Each record carries the instance the timer belongs to (None for the
+       instance the monitor runs on). Records are flushed right away, so they
+       survive a crash of the process, and synced to disk at most every
+       'syncInterval' seconds. After 'compactAfter' records the journal is
+       rewritten as a snapshot of the running timers and of the terminations
+       that have not been confirmed yet."""
+
+    def __init__(self, path, syncInterval=1.0, compactAfter=1000):
+        self._path = path
+        self._compactAfter = compactAfter
+        self._file = None
+        self._records = 0
+        self._dirty = False
+        self._nextIDs = {}
+        self._snapshot = None
+        self.pendingTerminations = set()
+        self._periodic = PeriodicCallback(self.sync, syncInterval*1000)
+
+    def load(self):
+        """Replays the journal and returns the timers that were still running."""
+        timers = {}
+        nextIDs = self._nextIDs
+        if not os.path.exists(self._path):
+            return []
+        with open(self._path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last record might have been cut off by a crash
+                    logger.warning("Skipping damaged record in %s", self._path)
+                    continue
+                instance = record.get('instance')
+                key = (instance, record.get('id'))
+                if record['op'] == 'add':
+                    timers[key] = {'id'       : record['id'],
+                                   'instance' : instance,
+                                   'start'    : record['start'],
+                                   'duration' : record['duration'],
+                                   'deadline' : record['start']+record['duration'],
+                                   'reason'   : record.get('reason')}
+                    nextIDs[instance] = max(nextIDs.get(instance, 1), record['id']+1)
+                elif record['op'] in ('cancel', 'fire'):
+                    timers.pop(key, None)
+                elif record['op'] == 'cancelAll':
+                    for timerKey in [timerKey for timerKey in timers if timerKey[0] == instance]:
+                        del timers[timerKey]
+                elif record['op'] == 'next':
+                    nextIDs[instance] = max(nextIDs.get(instance, 1), record['id'])
+                elif record['op'] == 'terminate':
+                    self.pendingTerminations.add(instance)
+                elif record['op'] == 'terminated':
+                    self.pendingTerminations.discard(instance)
+        # the next IDs of other instances are only kept while they have timers
+        running = set(timer['instance'] for timer in timers.itervalues())
+        for instance in list(nextIDs):
+            if (instance is not None) and (instance not in running):
+                del nextIDs[instance]
+        return sorted(timers.itervalues(), key=lambda timer: timer['deadline'])
+
+    def nextID(self, instance):
+        return self._nextIDs.get(instance, 1)
+
+    def forget(self, instance):
+        """Drops the next timer ID of an instance whose scheduler was dropped."""
+        self._nextIDs.pop(instance, None)
+
+    def open(self, snapshot):
+        """Starts a new journal. 'snapshot' returns all running timers and
+           is used whenever the journal is compacted."""
+        self._snapshot = snapshot
+        self.compact()
+        self._periodic.start()
+
+    def close(self):
+        self._periodic.stop()
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def _write(self, record):
+        self._file.write(json.dumps(record)+'\n')
+        self._file.flush()
+        self._dirty = True
+        self._records += 1
+        if self._records >= self._compactAfter:
+            self.compact()
+
+    def sync(self):
+        if self._dirty and (self._file is not None):
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def compact(self):
+        tmpPath = self._path+'.tmp'
+        with open(tmpPath, 'w') as f:
+            for instance, nextID in self._nextIDs.iteritems():
+                f.write(json.dumps({'op': 'next', 'instance': instance, 'id': nextID})+'\n')
+            for instance in self.pendingTerminations:
+                f.write(json.dumps({'op': 'terminate', 'instance': instance})+'\n')
+            for timer in self._snapshot():
+                f.write(json.dumps({'op'       : 'add',
+                                    'instance' : timer['instance'],
+                                    'id'       : timer['id'],
+                                    'start'    : timer['start'],
+                                    'duration' : timer['duration'],
+                                    'reason'   : timer['reason']})+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file is not None:
+            self._file.close()
+        os.rename(tmpPath, self._path)
+        self._file = open(self._path, 'a')
+        self._records = 0
+        self._dirty = False
+
+    def add(self, instance, timer):
+        self._nextIDs[instance] = max(self.nextID(instance), timer['id']+1)
+        self._write({'op'       : 'add',
+                     'instance' : instance,
+                     'id'       : timer['id'],
+                     'start'    : timer['start'],
+                     'duration' : timer['duration'],
+                     'reason'   : timer['reason']})
+
+    def cancel(self, instance, timerID):
+        self._write({'op': 'cancel', 'instance': instance, 'id': timerID})
+
+    def fire(self, instance, timerID):
+        self._write({'op': 'fire', 'instance': instance, 'id': timerID})
+
+    def cancelAll(self, instance):
+        self._write({'op': 'cancelAll', 'instance': instance})
+
+    def terminate(self, instance):
+        self.pendingTerminations.add(instance)
+        self._write({'op': 'terminate', 'instance': instance})
+
+    def terminated(self, instance):
+        self.pendingTerminations.discard(instance)
+        self._write({'op': 'terminated', 'instance': instance})
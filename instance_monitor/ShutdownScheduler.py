@@ -0,0 +1,164 @@
+#-------------------------------------------------------------
+#           Scheduler for the shutdown timers
+#
+#  Features:
+#  - min-heap of the timer deadlines plus an index of the timer IDs
+#  - a single IOLoop timeout armed for the earliest deadline
+#  - cancel single timers or all of them
+#  - notifies listeners whenever the schedule changes
+#  - records all changes in an optional journal
+#-------------------------------------------------------------
+
+import time
+import heapq
+import itertools
+
+from tornado.ioloop import IOLoop
+
+# identifies the monitor process, the versions of a schedule start again
+# after a restart and must not be mistaken for the ones seen before
+PROCESS_NONCE = '%x'%int(time.time()*1000)
+
+# the versions are shared by all schedulers, so a scheduler that is
+# created again for an instance never repeats a version of the previous one
+VERSIONS = itertools.count(1)
+
+
+class ShutdownScheduler(object):
+    """Keeps the shutdown timers in a min-heap keyed on their deadline and an
+       index keyed on their ID. Cancelled timers are removed from the index
+       right away and dropped from the heap once they reach its top.
+       'callback' is called with the timer whose deadline has passed.
+       Every change of the schedule increments 'version' and calls the listeners.
+       Clients see the version as tag(), which is unique across restarts.
+       'instanceID' names the instance the timers belong to, None stands for
+       the instance the monitor runs on. A timer can carry a 'reason', e.g.
+       'idle' for the timers armed by the idle detection."""
+
+    def __init__(self, callback, instanceID=None):
+        self.instanceID = instanceID
+        self._callback = callback
+        self._heap = []
+        self._timers = {}
+        self._nextID = 1
+        self._handle = None
+        self._armedDeadline = None
+        self._listeners = []
+        self._journal = None
+        self.version = 0
+
+    def __len__(self):
+        return len(self._timers)
+
+    def _compact(self):
+        # rebuild the heap once most of its entries belong to cancelled timers
+        if len(self._heap) > 2*len(self._timers)+16:
+            self._heap = [(timer['deadline'], timer['id']) for timer in self._timers.itervalues()]
+            heapq.heapify(self._heap)
+
+    def tag(self):
+        return '%s-%i'%(PROCESS_NONCE, self.version)
+
+    def _changed(self):
+        self.version = next(VERSIONS)
+        for listener in list(self._listeners):
+            listener(self)
+
+    def _record(self, method, *args):
+        if self._journal is not None:
+            getattr(self._journal, method)(self.instanceID, *args)
+
+    def setJournal(self, journal):
+        """Records all further changes in the journal."""
+        self._nextID = max(self._nextID, journal.nextID(self.instanceID))
+        self._journal = journal
+
+    def addListener(self, listener):
+        self._listeners.append(listener)
+
+    def removeListener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def hasListeners(self):
+        return len(self._listeners) > 0
+
+    def _arm(self):
+        timer = self.earliest()
+        deadline = timer['deadline'] if timer is not None else None
+        if deadline == self._armedDeadline:
+            return
+        if self._handle is not None:
+            IOLoop.instance().remove_timeout(self._handle)
+            self._handle = None
+        self._armedDeadline = deadline
+        if deadline is not None:
+            self._handle = IOLoop.instance().add_timeout(deadline, self._fire)
+
+    def _fire(self):
+        self._handle = None
+        self._armedDeadline = None
+        timer = self.earliest()
+        if (timer is not None) and (timer['deadline'] <= time.time()):
+            heapq.heappop(self._heap)
+            del self._timers[timer['id']]
+            self._record('fire', timer['id'])
+            self._arm()
+            self._changed()
+            self._callback(timer)
+        else:
+            self._arm()
+
+    def add(self, duration, start=None, timerID=None, reason=None):
+        if start is None:
+            start = time.time()
+        if timerID is None:
+            timerID = self._nextID
+        timer = {'id'       : timerID,
+                 'instance' : self.instanceID,
+                 'start'    : start,
+                 'duration' : duration,
+                 'deadline' : start+duration,
+                 'reason'   : reason}
+        self._nextID = max(self._nextID, timerID+1)
+        self._timers[timer['id']] = timer
+        heapq.heappush(self._heap, (timer['deadline'], timer['id']))
+        self._record('add', timer)
+        self._arm()
+        self._changed()
+        return timer
+
+    def cancel(self, timerID):
+        timer = self._timers.pop(timerID, None)
+        if timer is not None:
+            self._record('cancel', timerID)
+            self._compact()
+            self._arm()
+            self._changed()
+        return timer
+
+    def cancelAll(self):
+        self._timers.clear()
+        del self._heap[:]
+        self._record('cancelAll')
+        self._arm()
+        self._changed()
+
+    def get(self, timerID):
+        return self._timers.get(timerID)
+
+    def earliest(self):
+        while self._heap and (self._heap[0][1] not in self._timers):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return self._timers[self._heap[0][1]]
+
+    def timers(self):
+        return sorted(self._timers.itervalues(), key=lambda timer: timer['deadline'])
+
+    def state(self):
+        earliest = self.earliest()
+        return {'version'  : self.tag(),
+                'earliest' : earliest['deadline'] if earliest is not None else None,
+                'timers'   : self.timers()}
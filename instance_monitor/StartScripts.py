@@ -0,0 +1,132 @@
+#-------------------------------------------------------------
+#           Start scripts of the instance
+#
+#  Features:
+#  - runs the start scripts as child processes of the IOLoop
+#  - streams their stdout and stderr to the log
+#  - keeps the recent output, exit code and duration of every script
+#-------------------------------------------------------------
+
+import time
+import logging
+import itertools
+import collections
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.process import Subprocess
+
+logger = logging.getLogger(__name__)
+
+
+class StartScript(object):
+    """A single start script. The last 'maxLines' lines of its output are
+       kept, 'lines' counts all lines it has written so far. The lines are
+       numbered by 'numbers', which is shared by all scripts of a run."""
+
+    def __init__(self, command, maxLines=1000, numbers=None):
+        self.command = command
+        self._numbers = numbers if numbers is not None else itertools.count()
+        self.state = 'pending'
+        self.exitCode = None
+        self.started = None
+        self.finished = None
+        self.lines = 0
+        self._output = collections.deque(maxlen=maxLines)
+
+    def duration(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.time())-self.started
+
+    def addLine(self, stream, line):
+        self._output.append((next(self._numbers), stream, line))
+        self.lines += 1
+
+    def output(self, since=0):
+        return [{'line': number, 'stream': stream, 'text': line}
+                for number, stream, line in self._output if number >= since]
+
+    def status(self, since=0):
+        return {'command'  : self.command,
+                'state'    : self.state,
+                'exitCode' : self.exitCode,
+                'started'  : self.started,
+                'duration' : self.duration(),
+                'lines'    : self.lines,
+                'output'   : self.output(since)}
+
+
+class StartScriptRunner(object):
+    """Runs the start scripts one after the other without blocking the IOLoop.
+       A script that fails does not stop the following ones."""
+
+    def __init__(self, commands, maxLines=1000):
+        numbers = itertools.count()
+        self.scripts = [StartScript(command, maxLines, numbers) for command in commands]
+
+    def start(self):
+        IOLoop.instance().add_future(self.run(), self._unexpectedFailure)
+
+    def _unexpectedFailure(self, future):
+        if future.exception() is not None:
+            logger.error("Start scripts stopped: %s", future.exception())
+
+    def status(self, since=0):
+        return [script.status(since) for script in self.scripts]
+
+    @gen.coroutine
+    def _stream(self, script, name, stream):
+        partial = ['']
+        def received(data):
+            lines = (partial[0]+data).split('\n')
+            partial[0] = lines.pop()
+            for line in lines:
+                logger.info("[%s] %s", script.command, line)
+                script.addLine(name, line)
+        try:
+            yield stream.read_until_close(streaming_callback=received)
+        except StreamClosedError:
+            pass
+        if partial[0]:
+            logger.info("[%s] %s", script.command, partial[0])
+            script.addLine(name, partial[0])
+
+    @gen.coroutine
+    def _run(self, script):
+        logger.info("Running start script: %s", script.command)
+        Subprocess.initialize()
+        exited = Future()
+        script.started = time.time()
+        script.state = 'running'
+        try:
+            process = Subprocess(script.command, shell=True, close_fds=True,
+                                 stdout=Subprocess.STREAM, stderr=Subprocess.STREAM)
+        except OSError as e:
+            script.addLine('stderr', str(e))
+            script.state = 'failed'
+            script.finished = time.time()
+            raise gen.Return(None)
+        process.set_exit_callback(exited.set_result)
+        try:
+            yield [self._stream(script, 'stdout', process.stdout),
+                   self._stream(script, 'stderr', process.stderr)]
+        except Exception as e:
+            # the exit code is not waited for, the output of the script is lost
+            logger.error("Reading the output of the start script failed: %s: %s", script.command, e)
+            script.addLine('stderr', str(e))
+            script.state = 'failed'
+            script.finished = time.time()
+            raise gen.Return(None)
+        script.exitCode = yield exited
+        script.finished = time.time()
+        script.state = 'finished' if script.exitCode == 0 else 'failed'
+        logger.info("Start script finished with exit code %i after %.1f s: %s",
+                    script.exitCode, script.duration(), script.command)
+
+    @gen.coroutine
+    def run(self):
+        for script in self.scripts:
+            yield self._run(script)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Synchrotron Light Source Australia Pty Ltd
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the Australian Synchrotron nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import hashlib
+
+from opus_launcher.Manifest import save_atomic
+
+
+#-----------------------
+#   Checksum manifest
+#-----------------------
+class Checksums(object):
+    """The checksums of the files of an EPN, keyed on the path relative to
+       the data folder. Stored in the format of md5sum/sha256sum, with
+       forward slashes in the paths."""
+
+    def __init__(self, algorithm='md5', digests=None):
+        self.algorithm = algorithm
+        self.digests = digests if digests is not None else {}
+
+    def __len__(self):
+        return len(self.digests)
+
+    def new(self):
+        return hashlib.new(self.algorithm)
+
+    def get(self, path):
+        return self.digests.get(path.replace(os.sep, '/'))
+
+    def set(self, path, digest):
+        self.digests[path.replace(os.sep, '/')] = digest
+
+    def save(self, filename):
+        def write(f):
+            for path in sorted(self.digests):
+                f.write("%s  %s\n" % (self.digests[path], path))
+        save_atomic(filename, write)
+
+    @classmethod
+    def load(cls, filename, algorithm='md5'):
+        """Returns the checksums in 'filename' or None if there is no such file."""
+        try:
+            with open(filename, 'r') as f:
+                lines = f.readlines()
+        except IOError:
+            return None
+        checksums = cls(algorithm)
+        for line in lines:
+            digest, sep, path = line.rstrip('\r\n').partition(' ')
+            if not sep:
+                continue
+            # md5sum marks files read in binary mode with '*'
+            checksums.digests[path.lstrip(' *')] = digest.lower()
+        return checksums
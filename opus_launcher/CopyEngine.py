@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Synchrotron Light Source Australia Pty Ltd
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the Australian Synchrotron nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import time
+import shutil
+import threading
+import itertools
+import Queue
+from multiprocessing.pool import ThreadPool
+
+from opus_launcher.Manifest import replace_file
+from opus_launcher.Transfer import create_transfer, BufferedTransfer
+
+
+# files up to this size are copied in batches
+SMALL_FILE_SIZE = 64*1024
+BATCH_SIZE = 4*1024*1024
+MAX_BATCH_FILES = 256
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def read_file(src):
+    """Returns the content of 'src' and None or None and the error."""
+    try:
+        with open(src, 'rb') as f:
+            return f.read(), None
+    except (IOError, OSError) as e:
+        return None, e
+
+
+#-----------------------
+#      Copy engine
+#-----------------------
+class CopyEngine(object):
+    """Copies files with a pool of worker threads, so the latency of the
+       archive is paid concurrently instead of once per file. The progress
+       of all workers is aggregated in bytes and can be read from any thread.
+       'on_progress' is called with the progress at most every 'interval'
+       seconds and once more when the copy has finished. Every file is
+       written to a temporary file first and renamed once it is complete,
+       so an interrupted copy never leaves a truncated file behind.
+       'transfer' is the backend that copies the bytes of a file.
+       If 'checksums' is given, the checksum of every file is computed while
+       it is copied and stored in 'digests'. A file whose checksum differs
+       from the one in 'expected' (keyed on the source path) is copied again
+       up to 'retries' times before it is reported as an error.
+       The files are copied in the order of their priority, prioritize()
+       moves a file to the front of the queue. 'on_ready' is called once
+       all files of the 'ready' subset given to run() have been copied.
+       Files up to 'small_size' bytes are grouped into batches of up to
+       'batch_size' bytes. The files of a batch are read concurrently by a
+       pool of 'readers' threads and written in one pass, so the open/close
+       latency of the archive is not paid one file after the other. A
+       small_size of 0 disables batching."""
+
+    def __init__(self, workers=8, on_progress=None, interval=0.1, transfer=None,
+                 checksums=None, expected=None, retries=2, on_ready=None,
+                 small_size=SMALL_FILE_SIZE, batch_size=BATCH_SIZE, readers=8):
+        self._num_workers = max(workers, 1)
+        self._small_size = small_size
+        self._batch_size = batch_size
+        self._num_readers = max(readers, 1)
+        self._readers = None
+        self._transfer = transfer if transfer is not None else create_transfer()
+        if checksums is not None and not self._transfer.supports_digest:
+            self._transfer = BufferedTransfer()
+        self._checksums = checksums
+        self._expected = expected if expected is not None else {}
+        self._retries = retries
+        self._on_ready = on_ready
+        self._ready = None
+        self._queue = Queue.PriorityQueue()
+        self._order = itertools.count()
+        self._entries = {}
+        self._taken = set()
+        self._on_progress = on_progress
+        self._interval = interval
+        self._last_report = 0
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._started = None
+        self._files_total = 0
+        self._files_done = 0
+        self._bytes_total = 0
+        self._bytes_done = 0
+        self._current = ''
+        self.errors = []
+        self.completed = []
+        self.digests = {}
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def progress(self):
+        """Returns the copied and total number of files and bytes, the name
+           of the file copied last, the throughput [bytes/s] and the estimated
+           remaining time [s] (None while unknown)."""
+        with self._lock:
+            elapsed = time.time()-self._started if self._started is not None else 0
+            throughput = self._bytes_done/elapsed if elapsed > 0 else 0
+            remaining = None
+            if throughput > 0:
+                remaining = (self._bytes_total-self._bytes_done)/throughput
+            return {'files_done'  : self._files_done,
+                    'files_total' : self._files_total,
+                    'bytes_done'  : self._bytes_done,
+                    'bytes_total' : self._bytes_total,
+                    'current'     : self._current,
+                    'throughput'  : throughput,
+                    'remaining'   : remaining}
+
+    def _report(self, force=False):
+        # coalesce the progress of all workers into a few calls per second
+        if self._on_progress is None:
+            return
+        with self._lock:
+            now = time.time()
+            if not force and now-self._last_report < self._interval:
+                return
+            self._last_report = now
+        self._on_progress(self.progress())
+
+    def make_dirs(self, dirs):
+        # parents are created before their children
+        for directory in sorted(set(dirs), key=lambda d: d.count(os.sep)):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+    def prioritize(self, src):
+        """Copies the file 'src' (or its batch) next, unless it is already
+           being copied."""
+        with self._lock:
+            if src not in self._entries or id(self._entries[src]) in self._taken:
+                return False
+            self._queue.put(((-1,), next(self._order), self._entries[src]))
+        return True
+
+    def _make_jobs(self, files, priority):
+        # a job is a single file or a batch of small files, batches get
+        # the priority of their most urgent file
+        keyed = sorted(((tuple(priority(entry)) if priority is not None else (), entry)
+                        for entry in files), key=lambda item: item[0])
+        jobs = []
+        batch = []
+        batch_bytes = 0
+        for key, entry in keyed:
+            if self._small_size <= 0 or entry[2] > self._small_size:
+                jobs.append((key, (entry,)))
+                continue
+            if not batch:
+                batch_key = key
+            batch.append(entry)
+            batch_bytes += entry[2]
+            if batch_bytes >= self._batch_size or len(batch) >= MAX_BATCH_FILES:
+                jobs.append((batch_key, tuple(batch)))
+                batch = []
+                batch_bytes = 0
+        if batch:
+            jobs.append((batch_key, tuple(batch)))
+        return jobs
+
+    def _finished(self, src):
+        # call on_ready once the last file of the ready subset is done
+        with self._lock:
+            if self._ready is None or src not in self._ready:
+                return
+            self._ready.discard(src)
+            if self._ready:
+                return
+            self._ready = None
+        self._on_ready()
+
+    def run(self, dirs, files, priority=None, ready=None):
+        """Creates the directories 'dirs' and copies the (source, destination,
+           size, mtime) entries in 'files'. The copies get the given mtime.
+           'priority' returns the sort key of an entry, lower keys are copied
+           first. 'ready' is the set of source paths on_ready waits for.
+           Returns the list of (source, error) pairs of the files that could
+           not be copied, the copied entries are listed in 'completed'."""
+        self.make_dirs(dirs)
+        with self._lock:
+            self._started = time.time()
+            self._files_total += len(files)
+            self._bytes_total += sum(entry[2] for entry in files)
+            jobs = self._make_jobs(files, priority)
+            for key, job in jobs:
+                for entry in job:
+                    self._entries[entry[0]] = job
+                self._queue.put(((0,)+key, next(self._order), job))
+            if ready is not None and self._on_ready is not None:
+                self._ready = set(src for src in ready if src in self._entries)
+        if self._ready is not None and not self._ready:
+            self._ready = None
+            self._on_ready()
+        if any(len(job) > 1 for key, job in jobs):
+            self._readers = ThreadPool(self._num_readers)
+        workers = [threading.Thread(target=self._work)
+                   for i in range(min(self._num_workers, len(jobs)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if self._readers is not None:
+            self._readers.close()
+            self._readers = None
+        self._report(True)
+        return self.errors
+
+    def _add_bytes(self, length):
+        with self._lock:
+            self._bytes_done += length
+        self._report()
+
+    def _copy_file(self, src, dest, size, mtime):
+        # the backend reports the bytes while it copies, so the progress of
+        # large files is reported as well. Returns False if the copy was cancelled.
+        tmp_dest = dest+'.part'
+        try:
+            for attempt in range(self._retries+1):
+                digest = self._checksums.new() if self._checksums is not None else None
+                if not self._transfer.copy(src, tmp_dest, size, self._add_bytes, self._cancelled, digest):
+                    return False
+                if digest is None:
+                    break
+                expected = self._expected.get(src)
+                if expected is None or digest.hexdigest() == expected:
+                    with self._lock:
+                        self.digests[src] = digest.hexdigest()
+                    break
+                with self._lock:
+                    self._bytes_total += size
+            else:
+                raise ChecksumError("checksum mismatch after %i attempts" % (self._retries+1))
+            shutil.copymode(src, tmp_dest)
+            os.utime(tmp_dest, (time.time(), mtime))
+            replace_file(tmp_dest, dest)
+        finally:
+            if os.path.exists(tmp_dest):
+                os.remove(tmp_dest)
+        return True
+
+    def _done(self, entry, error=None):
+        with self._lock:
+            if error is None:
+                self.completed.append(entry)
+            else:
+                self.errors.append((entry[0], error))
+            self._files_done += 1
+        self._finished(entry[0])
+        self._report()
+
+    def _copy_single(self, entry):
+        # returns False if the copy was cancelled
+        try:
+            if not self._copy_file(*entry):
+                return False
+        except (IOError, OSError, ChecksumError) as e:
+            self._done(entry, e)
+        else:
+            self._done(entry)
+        return True
+
+    def _write_file(self, src, dest, data, mtime):
+        # like _copy_file, a failed write never replaces the previous copy
+        tmp_dest = dest+'.part'
+        try:
+            with open(tmp_dest, 'wb') as f:
+                f.write(data)
+            shutil.copymode(src, tmp_dest)
+            os.utime(tmp_dest, (time.time(), mtime))
+            replace_file(tmp_dest, dest)
+        finally:
+            if os.path.exists(tmp_dest):
+                os.remove(tmp_dest)
+
+    def _copy_batch(self, batch):
+        # read the files of the batch concurrently, then write them in one pass.
+        # Returns False if the copy was cancelled.
+        contents = self._readers.map(read_file, [entry[0] for entry in batch])
+        for entry, (data, error) in zip(batch, contents):
+            if self._cancelled.is_set():
+                return False
+            src, dest, size, mtime = entry
+            if error is not None:
+                self._done(entry, error)
+                continue
+            if self._checksums is not None:
+                digest = self._checksums.new()
+                digest.update(data)
+                expected = self._expected.get(src)
+                if expected is not None and digest.hexdigest() != expected:
+                    # copy the file on its own, which retries it
+                    if not self._copy_single(entry):
+                        return False
+                    continue
+                with self._lock:
+                    self.digests[src] = digest.hexdigest()
+            try:
+                self._write_file(src, dest, data, mtime)
+            except (IOError, OSError) as e:
+                self._done(entry, e)
+                continue
+            self._add_bytes(len(data))
+            self._done(entry)
+        return True
+
+    def _work(self):
+        while not self._cancelled.is_set():
+            try:
+                key, order, job = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+            with self._lock:
+                # a prioritized job is queued twice
+                if id(job) in self._taken:
+                    continue
+                self._taken.add(id(job))
+                self._current = os.path.basename(job[0][0])
+            if len(job) > 1:
+                copied = self._copy_batch(job)
+            else:
+                copied = self._copy_single(job[0])
+            if not copied:
+                return
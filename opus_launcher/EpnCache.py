@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Synchrotron Light Source Australia Pty Ltd
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the Australian Synchrotron nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import json
+import time
+
+from opus_launcher.Manifest import save_atomic
+
+# free space that is left on the disk for OPUS and the system
+RESERVE = 100*1024*1024
+
+
+def free_space(path):
+    """Returns the bytes available to the user on the disk of 'path'."""
+    if sys.platform == "win32":
+        import ctypes
+        free = ctypes.c_ulonglong(0)
+        if not ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(path), ctypes.byref(free),
+                                                          None, None):
+            raise ctypes.WinError()
+        return free.value
+    info = os.statvfs(path)
+    return info.f_bavail*info.f_frsize
+
+
+class NoSpaceError(Exception):
+    pass
+
+
+#-----------------------
+#       EPN cache
+#-----------------------
+class EpnCache(object):
+    """Index of the EPNs in the destination folder. Every EPN is stored
+       with its size in bytes and the time it was last used."""
+
+    def __init__(self, entries=None):
+        self.entries = entries if entries is not None else {}
+
+    def __contains__(self, epn):
+        return epn in self.entries
+
+    def total_size(self):
+        return sum(entry['size'] for entry in self.entries.itervalues())
+
+    def touch(self, epn, size, accessed=None):
+        self.entries[epn] = {'size'     : size,
+                             'accessed' : accessed if accessed is not None else time.time()}
+
+    def remove(self, epn):
+        self.entries.pop(epn, None)
+
+    def plan_eviction(self, sizes, needed, free, budget=0):
+        """Returns the least recently used EPNs that have to be evicted, so
+           the EPNs in 'sizes' (EPN -> size after the copy) fit into the
+           'budget' and 'needed' bytes fit into the 'free' bytes of the disk,
+           and whether the copy fits then. The EPNs in 'sizes' are never
+           evicted and a budget of 0 means no budget."""
+        used = sum(entry['size'] for epn, entry in self.entries.iteritems()
+                   if epn not in sizes)+sum(sizes.itervalues())
+        evict = []
+        for epn in sorted((epn for epn in self.entries if epn not in sizes),
+                          key=lambda epn: self.entries[epn]['accessed']):
+            if (budget <= 0 or used <= budget) and needed <= free:
+                break
+            evict.append(epn)
+            used -= self.entries[epn]['size']
+            free += self.entries[epn]['size']
+        return evict, needed <= free
+
+    def save(self, filename):
+        save_atomic(filename, lambda f: json.dump(self.entries, f))
+
+    @classmethod
+    def load(cls, filename):
+        """Returns the saved index or an empty one if there is none."""
+        try:
+            with open(filename, 'r') as f:
+                return cls(json.load(f))
+        except (IOError, ValueError):
+            return cls()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Synchrotron Light Source Australia Pty Ltd
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the Australian Synchrotron nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import json
+from PySide.QtCore import *
+
+from opus_launcher.Manifest import scandir, save_atomic
+
+# rows added to the list view at a time
+FETCH_SIZE = 500
+
+
+def list_epns(path, stopped=None):
+    """Returns the sorted names of the folders in 'path'. With scandir the
+       type of an entry comes with the directory listing, which saves a stat
+       call per entry on network shares. Returns None once 'stopped' returns True."""
+    names = []
+    if scandir is not None:
+        entries = ((entry.name, entry.is_dir) for entry in scandir(path))
+    else:
+        entries = ((name, lambda name=name: os.path.isdir(os.path.join(path, name)))
+                   for name in os.listdir(path))
+    for name, is_dir in entries:
+        if stopped is not None and stopped():
+            return None
+        if is_dir():
+            names.append(name)
+    return sorted(names)
+
+
+#-----------------------
+#     Cached listing
+#-----------------------
+def load_listing(filename, src_path):
+    """Returns the cached (mtime, EPNs) of 'src_path' or (None, []) if there are none."""
+    try:
+        with open(filename, 'r') as f:
+            document = json.load(f)
+    except (IOError, ValueError):
+        return None, []
+    if document.get('source') != src_path:
+        return None, []
+    return document['mtime'], document['epns']
+
+
+def save_listing(filename, src_path, mtime, epns):
+    save_atomic(filename, lambda f: json.dump({'source': src_path, 'mtime': mtime, 'epns': epns}, f))
+
+
+class EpnScanner(QThread):
+    """Lists the EPNs of the archive in the background. The archive is only
+       listed again if the mtime of its folder differs from the cached one,
+       adding or removing an EPN folder changes it. 'scanned' is emitted
+       with the sorted EPNs if they were listed again. stop() ends the
+       listing early, the thread still has to be waited for."""
+
+    scanned = Signal(object)
+    failed = Signal(object)
+
+    def __init__(self, src_path, cache_filename, mtime=None, parent=None):
+        QThread.__init__(self, parent)
+        self._src_path = src_path
+        self._cache_filename = cache_filename
+        self._mtime = mtime
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def stopped(self):
+        return self._stopped
+
+    def run(self):
+        try:
+            mtime = os.stat(self._src_path).st_mtime
+            if mtime == self._mtime:
+                return
+            epns = list_epns(self._src_path, self.stopped)
+        except OSError as e:
+            self.failed.emit(e)
+            return
+        if epns is None:
+            return
+        self.scanned.emit(epns)
+        try:
+            cache_dir = os.path.dirname(self._cache_filename)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            save_listing(self._cache_filename, self._src_path, mtime, epns)
+        except (IOError, OSError):
+            # the listing is cached on a best effort basis
+            pass
+
+
+#-----------------------
+#        EPN model
+#-----------------------
+class EpnModel(QAbstractListModel):
+    """The EPNs matching the filter text. The rows are handed to the view
+       in chunks of FETCH_SIZE while it scrolls, so thousands of EPNs do not
+       slow down showing or filtering the list."""
+
+    def __init__(self, parent=None):
+        QAbstractListModel.__init__(self, parent)
+        self._epns = []
+        self._filter = ''
+        self._matches = []
+        self._fetched = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self._fetched
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self._fetched:
+            return None
+        if role == Qt.DisplayRole:
+            return self._matches[index.row()]
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._fetched < len(self._matches)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        count = min(FETCH_SIZE, len(self._matches)-self._fetched)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self._fetched, self._fetched+count-1)
+        self._fetched += count
+        self.endInsertRows()
+
+    def match_count(self):
+        return len(self._matches)
+
+    def find(self, epn):
+        """Returns the index of 'epn' among the matches, the rows up to it are
+           fetched. The index is invalid if 'epn' does not match."""
+        try:
+            row = self._matches.index(epn)
+        except ValueError:
+            return QModelIndex()
+        if row >= self._fetched:
+            self.beginInsertRows(QModelIndex(), self._fetched, row)
+            self._fetched = row+1
+            self.endInsertRows()
+        return self.index(row)
+
+    def _reset(self, matches):
+        self.beginResetModel()
+        self._matches = matches
+        self._fetched = min(FETCH_SIZE, len(matches))
+        self.endResetModel()
+
+    def set_epns(self, epns):
+        self._epns = epns
+        self._reset(self._filtered(self._epns, self._filter))
+
+    def set_filter(self, text):
+        # a longer filter text only narrows down the current matches
+        text = text.strip().lower()
+        if text.startswith(self._filter):
+            candidates = self._matches
+        else:
+            candidates = self._epns
+        self._filter = text
+        self._reset(self._filtered(candidates, text))
+
+    def _filtered(self, epns, text):
+        if not text:
+            return list(epns)
+        return [epn for epn in epns if text in epn.lower()]
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Synchrotron Light Source Australia Pty Ltd
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the Australian Synchrotron nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import json
+import stat
+
+# scandir returns the file attributes together with the directory listing,
+# which saves a stat call per file on Windows and network file systems
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# files whose mtimes differ by less than this are considered unchanged,
+# FAT file systems store the mtime with a resolution of 2 seconds
+MTIME_TOLERANCE = 2
+
+
+#-----------------------
+#       Manifest
+#-----------------------
+class Manifest(object):
+    """The directories and files below a root directory. The paths are
+       relative to the root, every file is stored as (path, size, mtime)."""
+
+    def __init__(self, dirs=None, files=None):
+        self.dirs = dirs if dirs is not None else []
+        self.files = files if files is not None else []
+
+    def total_size(self):
+        return sum(size for path, size, mtime in self.files)
+
+    def diff(self, other):
+        """Returns the files that are missing in 'other' or differ in size or mtime."""
+        known = dict((path, (size, mtime)) for path, size, mtime in other.files)
+        changed = []
+        for path, size, mtime in self.files:
+            if path not in known:
+                changed.append((path, size, mtime))
+                continue
+            other_size, other_mtime = known[path]
+            if size != other_size or abs(mtime-other_mtime) >= MTIME_TOLERANCE:
+                changed.append((path, size, mtime))
+        return changed
+
+    def save(self, filename):
+        save_atomic(filename, lambda f: json.dump({'dirs': self.dirs, 'files': self.files}, f))
+
+    @classmethod
+    def load(cls, filename):
+        """Returns the saved manifest or None if there is none or it is damaged."""
+        try:
+            with open(filename, 'r') as f:
+                document = json.load(f)
+            return cls(document['dirs'], [tuple(entry) for entry in document['files']])
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    @classmethod
+    def scan(cls, root):
+        """Walks the tree below 'root' in a single pass."""
+        manifest = cls()
+        pending = ['']
+        while pending:
+            rel_dir = pending.pop()
+            for name, is_dir, size, mtime in list_dir(os.path.join(root, rel_dir)):
+                rel_path = os.path.join(rel_dir, name)
+                if is_dir:
+                    manifest.dirs.append(rel_path)
+                    pending.append(rel_path)
+                else:
+                    manifest.files.append((rel_path, size, mtime))
+        return manifest
+
+
+def replace_file(src, dest):
+    """Renames 'src' to 'dest'. Windows does not replace an existing file
+       on rename, so it is removed first there."""
+    if sys.platform == "win32" and os.path.exists(dest):
+        os.remove(dest)
+    os.rename(src, dest)
+
+
+def save_atomic(filename, write):
+    """Calls 'write' with a temporary file that then replaces 'filename'.
+       The data is synced to disk before the rename, so after a crash the
+       file holds either its previous or its new content."""
+    tmp_filename = filename+'.part'
+    with open(tmp_filename, 'w') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    replace_file(tmp_filename, filename)
+
+
+def list_dir(path):
+    """Returns (name, is_dir, size, mtime) for every entry of 'path'.
+       Symbolic links are followed."""
+    if not os.path.isdir(path):
+        return []
+    if scandir is not None:
+        result = []
+        for entry in scandir(path):
+            if entry.is_dir():
+                result.append((entry.name, True, 0, 0))
+            else:
+                info = entry.stat()
+                result.append((entry.name, False, info.st_size, info.st_mtime))
+        return result
+    result = []
+    for name in os.listdir(path):
+        info = os.stat(os.path.join(path, name))
+        if stat.S_ISDIR(info.st_mode):
+            result.append((name, True, 0, 0))
+        else:
+            result.append((name, False, info.st_size, info.st_mtime))
+    return result
@@ -34,9 +34,16 @@ import threading
 from subprocess import Popen
 from sys import platform
 import argparse
+import fnmatch
 from PySide.QtCore import *
 from PySide.QtGui import *
 import xml.etree.ElementTree as ET
+from opus_launcher.CopyEngine import CopyEngine, SMALL_FILE_SIZE, BATCH_SIZE
+from opus_launcher.Transfer import create_transfer, BUFFER_SIZE
+from opus_launcher.Manifest import Manifest, list_dir
+from opus_launcher.Checksums import Checksums
+from opus_launcher.EpnCache import EpnCache, NoSpaceError, free_space, RESERVE
+from opus_launcher.EpnList import EpnModel, EpnScanner, load_listing
 
 #-----------------------
 # OS dependent settings 
@@ -47,6 +54,81 @@ if platform == "win32":
     ctypes.windll.kernel32.Wow64DisableWow64FsRedirection(ctypes.byref(ctypes.c_long()))
 
 
+# copy settings that have to be numbers
+NUMERIC_COPY_SETTINGS = [('workers', int), ('progressInterval', float), ('bufferSize', int),
+                         ('smallFileSize', int), ('batchSize', int), ('readers', int),
+                         ('budget', int), ('reserve', int)]
+
+# labels of the progress while the copy is prepared
+PREPARE_TEXTS = {'scanning' : "Scanning %s...",
+                 'evicting' : "Removing %s from the local drive..."}
+
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%i:%02i:%02i" % (hours, minutes, seconds)
+
+
+class CopyWorker(QThread):
+    """Prepares the copy and runs the copy engine in the background.
+       'prepare' is called with a report and a cancelled callback, it scans
+       the EPNs and returns the arguments of CopyEngine.run() plus the ones
+       of the engine, or None if the copy was cancelled meanwhile. While
+       preparing, the progress is {'state': ..., 'epn': ...}, then the
+       progress of the engine is forwarded at most every 'interval' seconds.
+       'ready' is emitted once the files of the ready subset have been
+       copied. 'engine' stays None and 'failure' tells why if the copy
+       could not be prepared."""
+
+    progress = Signal(object)
+    ready = Signal()
+
+    def __init__(self, prepare, parent=None):
+        QThread.__init__(self, parent)
+        self._prepare = prepare
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self.engine = None
+        self.failure = None
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self.engine is not None:
+                self.engine.cancel()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def report(self, state, epn):
+        self.progress.emit({'state': state, 'epn': epn})
+
+    def run(self):
+        try:
+            prepared = self._prepare(self.report, self.cancelled)
+        except (IOError, OSError, ValueError, KeyError, NoSpaceError) as e:
+            self.failure = e
+            return
+        if prepared is None:
+            return
+        dirs, files, priority, ready, engine_args = prepared
+        with self._lock:
+            if self._cancelled:
+                return
+            self.engine = CopyEngine(on_progress=self.progress.emit, on_ready=self.ready.emit,
+                                     **engine_args)
+        self.engine.run(dirs, files, priority, ready)
+
+
 class OpusLauncher(QWidget):
     """The main opus launcher window."""
 
@@ -61,6 +143,8 @@ class OpusLauncher(QWidget):
         self._node_settings = root.find('app')
         self._title = self._node_settings.find('title').text
         self._opus_settings = root.find('opus')
+        self._copy_settings = root.find('copy')
+        self._copy_worker = None
 
         # Create the main layout
         self._main_layout = QVBoxLayout()
@@ -97,9 +181,44 @@ class OpusLauncher(QWidget):
         layout.addWidget(title_label)
 
 
+    def selected_epns(self):
+        return [index.data() for index in self._epn_selection.selectedRows()]
+
+
     def enable_launch_button(self):
-        if len(self._epn_list.selectedItems()) > 0:
-            self._launch_button.setEnabled(True)
+        self._launch_button.setEnabled(len(self.selected_epns()) > 0)
+
+
+    def restore_selection(self, epns):
+        # resetting the model clears the selection without emitting
+        # selectionChanged, the EPNs are selected again by their name
+        for epn in epns:
+            index = self._epn_model.find(epn)
+            if index.isValid():
+                self._epn_selection.select(index, QItemSelectionModel.Select)
+        self.enable_launch_button()
+
+
+    def show_epns(self, epns):
+        selected = self.selected_epns()
+        self._epn_model.set_epns(epns)
+        self.restore_selection(selected)
+        self.show_epn_count()
+
+
+    def show_epn_count(self):
+        self._epn_status.setText("%i experiment(s)" % self._epn_model.match_count())
+
+
+    def filter_epns(self, text):
+        selected = self.selected_epns()
+        self._epn_model.set_filter(text)
+        self.restore_selection(selected)
+        self.show_epn_count()
+
+
+    def scan_failed(self, error):
+        self._epn_status.setText("The archive could not be listed: %s" % error)
 
 
     def create_widget_epn(self, root):
@@ -114,19 +233,35 @@ class OpusLauncher(QWidget):
         instruction_label.setWordWrap(True)
         layout.addWidget(instruction_label)
 
-        # Get a list of the EPN folders
+        # Add the search field
         self._src_path = root.find('source').text
         self._dest_path = root.find('destination').text
-        epn_dirs = [name for name in os.listdir(self._src_path)
-                    if os.path.isdir(os.path.join(self._src_path, name))]
-
-        # Add the list widget and fill it with data
-        self._epn_list = QListWidget(self)
-        self._epn_list.setSelectionMode(QAbstractItemView.ExtendedSelection)
-        self._epn_list.itemSelectionChanged.connect(self.enable_launch_button)
-        for epn_dir in epn_dirs:
-            self._epn_list.addItem(epn_dir)
-        layout.addWidget(self._epn_list)
+        self._epn_filter = QLineEdit(self)
+        self._epn_filter.setPlaceholderText("Search")
+        self._epn_filter.textChanged.connect(self.filter_epns)
+        layout.addWidget(self._epn_filter)
+
+        # Add the list view, it shows the cached list of the EPN folders
+        # right away and is updated once the archive has been listed
+        self._epn_model = EpnModel(self)
+        self._epn_view = QListView(self)
+        self._epn_view.setModel(self._epn_model)
+        self._epn_view.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self._epn_view.setUniformItemSizes(True)
+        self._epn_selection = self._epn_view.selectionModel()
+        self._epn_selection.selectionChanged.connect(lambda selected, deselected: self.enable_launch_button())
+        self._epn_model.modelReset.connect(self.enable_launch_button)
+        layout.addWidget(self._epn_view)
+        self._epn_status = QLabel("Listing the archive...", self)
+        layout.addWidget(self._epn_status)
+        listing_path = os.path.join(self._dest_path, ".manifests", "epns.json")
+        mtime, epns = load_listing(listing_path, self._src_path)
+        if mtime is not None:
+            self.show_epns(epns)
+        self._epn_scanner = EpnScanner(self._src_path, listing_path, mtime, self)
+        self._epn_scanner.scanned.connect(self.show_epns)
+        self._epn_scanner.failed.connect(self.scan_failed)
+        self._epn_scanner.start()
 
         # Add the start launch button
         self._launch_button = QPushButton("Start OPUS")
@@ -159,6 +294,12 @@ class OpusLauncher(QWidget):
         self._progress_bar = QProgressBar(self)
         layout.addWidget(self._progress_bar)
         layout.addStretch(1)
+
+        # Add the cancel button
+        self._cancel_button = QPushButton("Cancel")
+        self._cancel_button.setFixedHeight(50)
+        self._cancel_button.clicked.connect(self.cancel_copy)
+        layout.addWidget(self._cancel_button)
         return widget
 
 
@@ -174,72 +315,377 @@ class OpusLauncher(QWidget):
         layout.addWidget(self._launch_label)
         layout.addStretch(1)
 
+        # Add the progress of the files that are copied while OPUS runs
+        self._background_label = QLabel(self)
+        self._background_label.setWordWrap(True)
+        layout.addWidget(self._background_label)
+        self._fetch_button = QPushButton("Copy selected files first...")
+        self._fetch_button.clicked.connect(self.fetch_files)
+        layout.addWidget(self._fetch_button)
+        self._background_label.setVisible(False)
+        self._fetch_button.setVisible(False)
+
         # Add the close button
         close_button = QPushButton("Close")
         close_button.setFixedHeight(50)
-        close_button.clicked.connect(exit)
+        close_button.clicked.connect(self.close_launcher)
         layout.addWidget(close_button)
         return widget
 
 
+    def copy_setting(self, name, default, convert=str):
+        # the copy settings are optional
+        if self._copy_settings is None or self._copy_settings.find(name) is None:
+            return default
+        return convert(self._copy_settings.find(name).text)
+
+    def check_copy_settings(self):
+        # validate the copy settings before the copy worker starts, so the
+        # user is told about a bad setting. Returns the error or None.
+        for name, convert in NUMERIC_COPY_SETTINGS:
+            try:
+                self.copy_setting(name, 0, convert)
+            except (TypeError, ValueError):
+                return "The copy setting '%s' must be a number." % name
+        algorithm = self.copy_setting('checksum', 'md5')
+        try:
+            Checksums(algorithm).new()
+        except (TypeError, ValueError):
+            return "The checksum algorithm '%s' is not available." % algorithm
+        if self.copy_setting('verify', 'auto') not in ('auto', 'always', 'never'):
+            return "The copy setting 'verify' must be auto, always or never."
+        if self.copy_setting('backend', 'auto') not in ('auto', 'system', 'buffered'):
+            return "The copy setting 'backend' must be auto, system or buffered."
+        if self.copy_setting('manifestCache', 'true') is None:
+            return "The copy setting 'manifestCache' must be true or false."
+        return None
+
     def make_dirs(self, dest):
         if not os.path.exists(dest):
             os.makedirs(dest)
 
     def source_dir(self, epn):
-        return os.path.join(self._src_path, epn, "data")
-
-    def count_files(self, epns):
-        result = 0
+        return os.path.normpath(os.path.join(self._src_path, epn, "data"))
+
+    def manifest_path(self, epn):
+        return os.path.join(self._dest_path, ".manifests", epn+".json")
+
+    def local_manifest(self, epn):
+        # the manifest saved after the last copy saves scanning the local
+        # copy, it is only trusted as long as the local copy exists
+        dest = os.path.join(self._dest_path, epn)
+        manifest = None
+        if self.copy_setting('manifestCache', 'true').lower() == 'true' and os.path.exists(dest):
+            manifest = Manifest.load(self.manifest_path(epn))
+        if manifest is None:
+            manifest = Manifest.scan(dest)
+        return manifest
+
+    def checksums_path(self, epn, algorithm):
+        return os.path.join(self._dest_path, ".manifests", epn+"."+algorithm)
+
+    def plan_copy(self, epns, report=None, cancelled=None):
+        # collect the directories and the new or changed files of the EPNs,
+        # the archive is scanned only once per EPN. The checksums stored next
+        # to an EPN on the archive are expected for the copied files.
+        dirs = []
+        files = []
+        self._manifests = {}
+        self._expected = {}
+        algorithm = self.copy_setting('checksum', 'md5')
+        verify = self.copy_setting('verify', 'auto')
+        self._verify = (verify == 'always')
+        for epn in epns:
+            if cancelled is not None and cancelled():
+                break
+            if report is not None:
+                report('scanning', epn)
+            src  = self.source_dir(epn)
+            dest = os.path.join(self._dest_path, epn)
+            manifest = Manifest.scan(src)
+            changed = manifest.diff(self.local_manifest(epn))
+            self._manifests[epn] = (manifest, changed)
+            if verify != 'never':
+                archive_checksums = Checksums.load(os.path.join(self._src_path, epn, "checksums."+algorithm),
+                                                   algorithm)
+                if archive_checksums is not None:
+                    self._verify = True
+                    for path, size, mtime in changed:
+                        if archive_checksums.get(path) is not None:
+                            self._expected[os.path.join(src, path)] = archive_checksums.get(path)
+            dirs.append(dest)
+            dirs.extend(os.path.join(dest, path) for path in manifest.dirs)
+            files.extend((os.path.join(src, path), os.path.join(dest, path), size, mtime)
+                         for path, size, mtime in changed)
+        return dirs, files
+
+    def save_manifests(self, completed):
+        # record the files that are up to date, missing files are copied next time
+        self.make_dirs(os.path.join(self._dest_path, ".manifests"))
+        completed = set(src_file for src_file, dest_file, size, mtime in completed)
+        for epn, (manifest, changed) in self._manifests.iteritems():
+            src = self.source_dir(epn)
+            missing = set(entry[0] for entry in changed
+                          if os.path.join(src, entry[0]) not in completed)
+            local_manifest = Manifest(manifest.dirs, [entry for entry in manifest.files
+                                                      if entry[0] not in missing])
+            local_manifest.save(self.manifest_path(epn))
+            self._cache.touch(epn, local_manifest.total_size())
+
+    def save_checksums(self, digests):
+        # cache the checksums computed while copying next to the manifests
+        algorithm = self.copy_setting('checksum', 'md5')
+        for epn, (manifest, changed) in self._manifests.iteritems():
+            src = self.source_dir(epn)
+            checksums = Checksums.load(self.checksums_path(epn, algorithm), algorithm) or Checksums(algorithm)
+            for path, size, mtime in changed:
+                if os.path.join(src, path) in digests:
+                    checksums.set(path, digests[os.path.join(src, path)])
+            checksums.save(self.checksums_path(epn, algorithm))
+
+
+    def save_copy_state(self, engine):
+        self.save_manifests(engine.completed)
+        self._cache.save(self.cache_path())
+        if self._verify:
+            self.save_checksums(engine.digests)
+
+    def cache_path(self):
+        return os.path.join(self._dest_path, ".manifests", "cache.json")
+
+    def is_epn_copy(self, epn):
+        # a folder of the destination is only a copy of an EPN if the launcher
+        # saved its manifest or the EPN exists on the archive
+        return os.path.exists(self.manifest_path(epn)) or os.path.isdir(self.source_dir(epn))
+
+    def load_cache(self, report=None):
+        # EPNs copied before the index existed are added with the time they
+        # were last modified, EPNs that were removed by hand are dropped.
+        # Other folders of the destination are left alone, they are never evicted.
+        cache = EpnCache.load(self.cache_path())
+        epns = set(name for name, is_dir, size, mtime in list_dir(self._dest_path)
+                   if is_dir and not name.startswith('.') and self.is_epn_copy(name))
+        for epn in list(cache.entries):
+            if epn not in epns:
+                cache.remove(epn)
         for epn in epns:
-            files = []
-            for path, dirs, filenames in os.walk(self.source_dir(epn)):
-                files.extend(filenames)
-            result += len(files)
-        return result
+            if epn not in cache:
+                if report is not None:
+                    report('scanning', epn)
+                cache.touch(epn, self.local_manifest(epn).total_size(),
+                            os.path.getmtime(os.path.join(self._dest_path, epn)))
+        return cache
+
+    def evict_epn(self, epn):
+        # remove the manifest first, so a partly removed EPN is scanned next time
+        for path in (self.manifest_path(epn),
+                     self.checksums_path(epn, self.copy_setting('checksum', 'md5'))):
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(os.path.join(self._dest_path, epn), True)
+        self._cache.remove(epn)
+
+    def prepare_cache(self, epns, files, report=None):
+        # make room before the copy starts, so it never runs out of disk space
+        # halfway: the least recently used EPNs are evicted while the cache
+        # exceeds its budget or the new files do not fit on the disk
+        self.make_dirs(os.path.join(self._dest_path, ".manifests"))
+        self._cache = self.load_cache(report)
+        sizes = dict((epn, self._manifests[epn][0].total_size()) for epn in epns)
+        needed = sum(entry[2] for entry in files)+self.copy_setting('reserve', RESERVE, int)
+        free = free_space(self._dest_path)
+        evict, fits = self._cache.plan_eviction(sizes, needed, free,
+                                                self.copy_setting('budget', 0, int))
+        if not fits:
+            raise NoSpaceError("Not enough disk space for the selected experiment(s): "+
+                               "%s needed, %s free. No experiment has been removed."
+                               % (format_size(needed), format_size(free)))
+        for epn in evict:
+            if report is not None:
+                report('evicting', epn)
+            self.evict_epn(epn)
+        for epn, size in sizes.iteritems():
+            self._cache.touch(epn, size)
+        self._cache.save(self.cache_path())
+
+    def prepare_copy(self, epns, report, cancelled):
+        # runs in the copy worker: scan the EPNs, make room for them and
+        # return the arguments of the copy, None if it was cancelled
+        self.make_dirs(self._dest_path)
+        dirs, files = self.plan_copy(epns, report, cancelled)
+        if cancelled():
+            return None
+        self.prepare_cache(epns, files, report)
+        transfer = create_transfer(self.copy_setting('backend', 'auto'),
+                                   self.copy_setting('bufferSize', BUFFER_SIZE, int))
+        checksums = Checksums(self.copy_setting('checksum', 'md5')) if self._verify else None
+
+        # OPUS is started as soon as the files matching the ready patterns
+        # have been copied, without patterns once all files have been copied
+        patterns = self.copy_patterns('ready')
+        ready = None
+        if patterns:
+            ready = set(entry[0] for entry in files if self.matches(patterns, entry[0]))
+        engine_args = {'workers'    : self.copy_setting('workers', 8, int),
+                       'interval'   : self.copy_setting('progressInterval', 0.1, float),
+                       'transfer'   : transfer,
+                       'checksums'  : checksums,
+                       'expected'   : self._expected,
+                       'small_size' : self.copy_setting('smallFileSize', SMALL_FILE_SIZE, int),
+                       'batch_size' : self.copy_setting('batchSize', BATCH_SIZE, int),
+                       'readers'    : self.copy_setting('readers', 8, int)}
+        return dirs, files, self.copy_priority(patterns), ready, engine_args
+
+    def copy_patterns(self, name):
+        # file patterns of a setting, separated by semicolons
+        return [pattern.strip().lower() for pattern in self.copy_setting(name, '').split(';')
+                if pattern.strip() != '']
+
+    def matches(self, patterns, src_file):
+        name = os.path.basename(src_file).lower()
+        return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+    def copy_priority(self, patterns):
+        # the files of the ready subset first, then the smaller files
+        return lambda entry: (0 if self.matches(patterns, entry[0]) else 1, entry[2])
+
+
+    def report_errors(self, errors):
+        message = "%i file(s) could not be copied:\n\n" % len(errors)
+        message += "\n".join("%s: %s" % (src_file, error) for src_file, error in errors[:10])
+        QMessageBox.warning(self, self._title, message)
 
 
     def launch_opus(self):
+        # Get selected EPNs, there is nothing to copy without any
+        epns = self.selected_epns()
+        if not epns:
+            self.enable_launch_button()
+            return
+        error = self.check_copy_settings()
+        if error is not None:
+            QMessageBox.warning(self, self._title, error)
+            return
+
         # Show the progress widget
         self._epn_widget.hide()
         self._progress_widget.show()
         QApplication.processEvents()
 
-        # Check if the destination folder exists, if not create it
-        self.make_dirs(self._dest_path)
- 
-        # Get selected EPNs
-        epns = [epn.text() for epn in self._epn_list.selectedItems()]
-
-        # Count the number of files that will be copied
-        num_files = self.count_files(epns)
-
-        # Copy the files and folders and report the progress
-        if num_files > 0:
-            num_copied = 0
-            self._progress_bar.setMaximum(num_files)
-            for epn in epns:
-                src  = self.source_dir(epn)
-                dest = os.path.join(self._dest_path, epn)
-
-                # Copy the EPN folder only if the EPN hasn't been copied yet
-                if not os.path.exists(dest):
-                    self.make_dirs(dest)
-
-                    for path, dirs, filenames in os.walk(src):
-                        for directory in dirs:
-                            dest_dir = path.replace(src, dest)
-                            self.make_dirs(os.path.join(dest_dir, directory))
-                        for sfile in filenames:
-                            src_file = os.path.join(path, sfile)
-                            dest_file = os.path.join(path.replace(src, dest), sfile)
-                            shutil.copy(src_file, dest_file)
-                            num_copied += 1
-                            self._progress_label.setText(sfile)
-                            self._progress_bar.setValue(num_copied)
-            self._progress_bar.setValue(num_files)
-
-        # Show the launch widget and launch OPUS
+        # Scan the EPNs, make room for them and copy their files concurrently
+        # in the background, so the window stays responsive throughout
+        self._progress_label.setText("Scanning the selected experiment(s)...")
+        self._cancel_button.setEnabled(True)
+        self._opus_started = False
+        self._copy_worker = CopyWorker(lambda report, cancelled: self.prepare_copy(epns, report, cancelled),
+                                       self)
+        self._copy_worker.progress.connect(self.show_progress)
+        self._copy_worker.ready.connect(self.start_opus)
+        self._copy_worker.finished.connect(self.copy_finished)
+        self._copy_worker.start()
+
+
+    def show_progress(self, progress):
+        # the progress bar shows a busy indicator while the copy is prepared,
+        # then it counts per mille of the bytes, which fits into an int
+        if 'state' in progress:
+            self._progress_bar.setMaximum(0)
+            self._progress_label.setText(PREPARE_TEXTS[progress['state']] % progress['epn'])
+            return
+        self._progress_bar.setMaximum(1000)
+        text = "%s\n%i of %i files, %s of %s, %s/s" % (progress['current'],
+                                                      progress['files_done'], progress['files_total'],
+                                                      format_size(progress['bytes_done']),
+                                                      format_size(progress['bytes_total']),
+                                                      format_size(progress['throughput']))
+        if progress['remaining'] is not None:
+            text += ", %s remaining" % format_duration(progress['remaining'])
+        self._progress_label.setText(text)
+        self._background_label.setText("Copying the remaining files in the background: "+text)
+        if progress['bytes_total'] > 0:
+            self._progress_bar.setValue(1000*progress['bytes_done']/progress['bytes_total'])
+        else:
+            self._progress_bar.setValue(1000*progress['files_done']/max(progress['files_total'], 1))
+
+
+    def fetch_files(self):
+        # copy the files the user is about to open next
+        if self._copy_worker is None:
+            return
+        src_files, selected_filter = QFileDialog.getOpenFileNames(self, "Copy files first", self._src_path)
+        for src_file in src_files:
+            self._copy_worker.engine.prioritize(os.path.normpath(src_file))
+
+
+    def stop_workers(self):
+        # Qt aborts if a running thread is destroyed, so the threads are
+        # stopped and waited for. The remaining files are copied next time.
+        self._epn_scanner.stop()
+        if self._copy_worker is not None:
+            worker = self._copy_worker
+            self._copy_worker = None
+            worker.cancel()
+            worker.wait()
+            if worker.engine is not None:
+                self.save_copy_state(worker.engine)
+        self._epn_scanner.wait()
+
+
+    def closeEvent(self, event):
+        self.stop_workers()
+        QWidget.closeEvent(self, event)
+
+
+    def close_launcher(self):
+        self.stop_workers()
+        exit()
+
+
+    def cancel_copy(self):
+        self._cancel_button.setEnabled(False)
+        self._progress_label.setText("Cancelling...")
+        self._copy_worker.cancel()
+
+
+    def copy_finished(self):
+        # the copy might have been stopped by closing the launcher
+        worker = self._copy_worker
+        if worker is None:
+            return
+        self._copy_worker = None
+        engine = worker.engine
+        if worker.failure is not None:
+            QMessageBox.warning(self, self._title, "The files could not be copied: %s" % worker.failure)
+
+        # The copy failed or was cancelled before any file was copied
+        if engine is None:
+            self._progress_widget.hide()
+            self._epn_widget.show()
+            return
+        self.save_copy_state(engine)
+        if engine.errors:
+            self.report_errors(engine.errors)
+
+        self._background_label.setText("All files have been copied.")
+        self._fetch_button.setVisible(False)
+
+        # The files that have not been copied yet are copied next time
+        if engine.cancelled() and not self._opus_started:
+            self._progress_widget.hide()
+            self._epn_widget.show()
+            return
+        self.start_opus()
+
+
+    def start_opus(self):
+        # Show the launch widget and launch OPUS, a copy that is still
+        # running continues in the background
+        if self._opus_started:
+            return
+        self._opus_started = True
+        copying = self._copy_worker is not None
+        self._background_label.setVisible(copying)
+        self._fetch_button.setVisible(copying)
         self._progress_widget.hide()
         self._launch_widget.show()
         QApplication.processEvents()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Synchrotron Light Source Australia Pty Ltd
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the Australian Synchrotron nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+
+BUFFER_SIZE = 4*1024*1024
+
+# flags and return values of CopyFileExW
+COPY_FILE_NO_BUFFERING = 0x00001000
+PROGRESS_CONTINUE = 0
+PROGRESS_CANCEL = 1
+ERROR_REQUEST_ABORTED = 1235
+
+# files above this size bypass the cache of Windows, which would only be
+# polluted by a multi-gigabyte image that is read once
+UNBUFFERED_SIZE = 256*1024*1024
+
+
+#-----------------------
+#   Transfer backends
+#-----------------------
+def is_sparse(src):
+    """Checks whether the file has fewer blocks allocated than its size needs."""
+    info = os.stat(src)
+    if not hasattr(info, 'st_blocks'):
+        return False
+    return info.st_blocks*512 < info.st_size
+
+
+def preallocate(f, size):
+    # reserve the space up front, which avoids fragmentation and fails
+    # early if the disk is full
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(f.fileno(), 0, size)
+    elif sys.platform == "win32":
+        f.truncate(size)
+        f.seek(0)
+
+
+class BufferedTransfer(object):
+    """Copies through a single reused buffer of 'buffer_size' bytes. Runs of
+       zeros in sparse source files are skipped, so they stay sparse.
+       A digest passed to copy() is updated with the bytes while they are
+       copied, so a checksum needs no second read of the file."""
+
+    name = 'buffered'
+    supports_digest = True
+
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self._buffer_size = buffer_size
+
+    def copy(self, src, dest, size, on_bytes, cancelled, digest=None):
+        """Copies 'src' to 'dest' and calls 'on_bytes' with the number of bytes
+           of every chunk. Returns False if 'cancelled' was set."""
+        sparse = is_sparse(src)
+        buf = bytearray(self._buffer_size)
+        view = memoryview(buf)
+        with open(src, 'rb') as fsrc:
+            with open(dest, 'wb') as fdest:
+                if not sparse:
+                    preallocate(fdest, size)
+                while True:
+                    if cancelled.is_set():
+                        return False
+                    length = fsrc.readinto(buf)
+                    if not length:
+                        break
+                    if digest is not None:
+                        digest.update(view[:length])
+                    if sparse and buf.count('\0', 0, length) == length:
+                        fdest.seek(length, os.SEEK_CUR)
+                    else:
+                        fdest.write(view[:length])
+                    on_bytes(length)
+                # a file that ends in a hole or shrank since it was scanned
+                fdest.truncate(fsrc.tell())
+        return True
+
+
+class WindowsTransfer(object):
+    """Lets Windows copy the file with CopyFileExW, which copies within the
+       kernel and offloads the copy to the file server where SMB supports it."""
+
+    name = 'system'
+    supports_digest = False
+
+    def __init__(self):
+        import ctypes
+        from ctypes import wintypes
+        self._ctypes = ctypes
+        self._copy_file = ctypes.windll.kernel32.CopyFileExW
+        self._copy_file.argtypes = [wintypes.LPCWSTR, wintypes.LPCWSTR, ctypes.c_void_p,
+                                    ctypes.c_void_p, ctypes.POINTER(wintypes.BOOL), wintypes.DWORD]
+        self._copy_file.restype = wintypes.BOOL
+        self._routine_type = ctypes.WINFUNCTYPE(wintypes.DWORD, ctypes.c_longlong, ctypes.c_longlong,
+                                                ctypes.c_longlong, ctypes.c_longlong, wintypes.DWORD,
+                                                wintypes.DWORD, wintypes.HANDLE, wintypes.HANDLE,
+                                                ctypes.c_void_p)
+
+    def copy(self, src, dest, size, on_bytes, cancelled, digest=None):
+        transferred = [0]
+        def progress(total, done, stream_size, stream_done, stream, reason, hsrc, hdest, data):
+            on_bytes(done-transferred[0])
+            transferred[0] = done
+            return PROGRESS_CANCEL if cancelled.is_set() else PROGRESS_CONTINUE
+        routine = self._routine_type(progress)
+        flags = COPY_FILE_NO_BUFFERING if size >= UNBUFFERED_SIZE else 0
+        if not self._copy_file(unicode(src), unicode(dest), self._ctypes.cast(routine, self._ctypes.c_void_p),
+                               None, None, flags):
+            error = self._ctypes.GetLastError()
+            if error == ERROR_REQUEST_ABORTED:
+                return False
+            raise self._ctypes.WinError(error)
+        return True
+
+
+def create_transfer(backend='auto', buffer_size=BUFFER_SIZE):
+    """Returns the transfer backend 'system', 'buffered' or, for 'auto', the
+       fastest one available on this platform."""
+    if backend in ('auto', 'system') and sys.platform == "win32":
+        try:
+            return WindowsTransfer()
+        except (AttributeError, OSError):
+            pass
+    return BufferedTransfer(buffer_size)
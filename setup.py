@@ -18,7 +18,7 @@ setup(
     package_data={'welcome_screen': ['icons/*']},
     install_requires=[
         'argparse',
-        'tornado >= 2.4.1'
+        'tornado >= 4.0'
     ],
     classifiers=[
         'Environment :: OpenStack',
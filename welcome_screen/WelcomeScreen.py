@@ -168,9 +168,12 @@ class RaidarStartScreen(QWidget):
         return user_fullname
 
 
-    def get_greeting_NeCTAR(self):
+    def get_greeting_NeCTAR(self, url=None):
+        """Reads the username from the instance metadata. If instmonitord is
+           running, its cached copy (/metadata/get) can be used as the url."""
         try:
-            url = 'http://169.254.169.254/openstack/2012-08-10/meta_data.json'
+            if url == None:
+                url = 'http://169.254.169.254/openstack/2012-08-10/meta_data.json'
             req = urllib2.Request(url)
             resp = urllib2.urlopen(req)
             j = json.loads(resp.read())
@@ -216,7 +219,8 @@ class RaidarStartScreen(QWidget):
             greeting_text = templ.substitute(username=self.get_greeting_VirtualBox())
         elif greeting_type == "NeCTAR":
             templ = Template(self._node_settings.find('greetings').text)
-            greeting_text = templ.substitute(username=self.get_greeting_NeCTAR())
+            greeting_url = self._node_settings.find('greetings').attrib.get('url')
+            greeting_text = templ.substitute(username=self.get_greeting_NeCTAR(greeting_url))
         welcome_label = QLabel(greeting_text, self)
         main_layout.addWidget(welcome_label, 0, Qt.AlignLeft)
 